@@ -12,21 +12,64 @@ This is a basic regex checker.
 The regex check is performed by the 'match' method.
 It returns True or False depending on whether a match exists.
 
+The regex is first compiled by the 'compile' method into a Pattern,
+the sequence of steps the algorithm goes through, so that it is parsed
+only once. Compiled patterns are kept in a bounded LRU cache.
+Texts shorter than the pattern, or that do not contain its longest
+literal, are rejected before the search starts.
+
+The search can be followed by passing a tracer to 'match', or setting
+one with 'set_tracer'. Nothing is traced or printed by default.
+
 Running this script executes all tests.
 The tests are generated from the 'TESTS' list.
+Running it with --trace prints the search of every test.
+Running it with --bench [n] times the search of long literals in a
+text of n characters.
+
+'grep' and 'grep_file' match a regex against every line of a stream or
+a file, lazily and in constant memory. Running this script as
+    basic_regex.py grep [options] REGEX [FILE...]
+prints the number, offset and text of every matching line.
 
 ===ALGORITHM STRATEGY===
 STEP 0: First split the regex by the first wildcard.
 STEP 1: Find the substring on the left of the wildcard.
 STEP 2: If found, then make a recursive call to match the
-        part to the right of the wildcard, forming a new
-        challenge with all characters after the last character
-        of the left substring.
-STEP 3: If the right side matches, set result to True. Otherwise,
-        find  the next occurrence of the left substring and
-        go back to STEP 2.
+        part to the right of the wildcard, starting from the
+        offset after the last character of the left substring,
+        plus one for '+' and '?'. After a '?' the right part
+        must match right at that offset.
+        The challenge itself is never sliced or copied, only the
+        offsets move, so it can also be a bytearray or an mmap.
+STEP 3: If the right side matches, return True. Otherwise,
+        find  the next occurrence of the left substring, which
+        may overlap the previous one, and go back to STEP 2.
         The loop continues until the entire text is traversed.
 
+===GREEDY ENGINE===
+match(regex, challenge, engine='greedy') uses an iterative engine with
+the same semantics and an O(len(regex) * len(challenge)) worst case.
+It splits the regex by '*' and '+' into segments of characters and '?'.
+As the gap between two segments has no upper bound, it is enough to find
+the leftmost occurrence of every segment after the end of the previous
+one, leaving at least as many characters in between as there are '+'.
+There is never any need to backtrack.
+
+The greedy engine also finds where the match is, which 'search' and
+'finditer' return as Spans. The wildcards before the first character
+of the regex that is not one, and after the last, match as few characters
+as they can: none for '*' and one for every '+' and '?'. A span is then
+the leftmost match, so search('+a', 'xxa') is (1, 3) and not (0, 3).
+
+===LITERAL SEARCH===
+Both engines look for literals with the find method of the challenge,
+which runs in C and skips ahead with its own tables. Challenges without
+one, like array('c'), are searched by '_horspool' with the skip tables
+that compile stores with every literal. A memoryview is the exception:
+it is copied once per call, as searching it in C is much faster than
+reading it a character at a time.
+
 """
 
 __author__ = 'Orko Garai (orko.garai@gmail.com)'
@@ -34,11 +77,32 @@ __author__ = 'Orko Garai (orko.garai@gmail.com)'
 import warnings
 warnings.filterwarnings("ignore")
 
+from collections import Counter, namedtuple, OrderedDict
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from threading import Lock
+from array import array
+import argparse
+from StringIO import StringIO
+import mmap
+import os
+import pickle
+import random
+import re
+import tempfile
 import timeit
 import sys
 
 WILDCARDS = ['*', '+', '?']
 
+# Maximum number of compiled patterns kept by 'compile'
+CACHE_SIZE = 256
+
+DEFAULT_ENGINE = 'backtracking'
+
+# Number of bytes read at a time by 'grep'
+CHUNK_SIZE = 1 << 16
+
 TESTS = [
         ## Format: [regex, challenge, result]
 
@@ -91,6 +155,15 @@ TESTS = [
         ['abc?d', 'abc', False],
         ['abc?d', 'abcabc', False],
         ['*lmno*stu*', 'lmnoabcdefghijklmnopqrvwxyz', False],
+        ['a+*', 'aa', True],
+        ['a?*', 'ab', True],
+        ['??b', 'accbc', True],
+        ['?b', 'ccb', True],
+        ['a?b*', 'axcb', False],
+        ['a?b+', 'axcbb', False],
+        ['aa?b', 'aaacb', True],
+        ['', '', True],
+        ['', 'ab', True],
     ]
 
 
@@ -117,144 +190,793 @@ class SplitRegexByLeftMostWildCard:
     def __str__(self):
         return ("left: %s, wildcard: %s, right: %s" % (self.left, self.wildcard, self.right))
 
-# This variable is used to set the result of match, as we are calling the match method inside
-# timeit and then accumulating the results
-result = False
 
-indentation=''
+def _skip_table(literal):
+    """
+    Returns the Horspool skip table of literal: for every character but the
+    last one, how far the search may move when it is aligned with the end
+    of literal. The other characters move it by the whole length.
+    """
+    last = len(literal) - 1
+    return dict((ch, last - i) for i, ch in enumerate(literal[:last]))
+
+
+class Step(namedtuple('Step', 'left wildcard right skip')):
+    """
+    One split of the regex by its leftmost wildcard, where right is the
+    unparsed rest of the regex, kept for logging, and skip is the skip
+    table of left
+    """
+    __slots__ = ()
+
+    def __new__(cls, left, wildcard, right):
+        return super(Step, cls).__new__(cls, left, wildcard, right, _skip_table(left))
+
+    def __str__(self):
+        return ("left: %s, wildcard: %s, right: %s" % (self.left, self.wildcard, self.right))
+
+
+class Segment(namedtuple('Segment', 'gap text anchor_offset anchor checks skip')):
+    """
+    A run of characters and '?' between '*' and '+' wildcards, used by the
+    greedy engine. gap is the number of '+' before it, and of the '?' it
+    starts with, which are left out of text. The longest run
+    without '?' is the anchor that is searched for, at anchor_offset,
+    and checks are the (offset, run) pairs of the other runs.
+    skip is the skip table of the anchor.
+    """
+    __slots__ = ()
+
+    def __new__(cls, gap, text):
+        runs = []
+        offset = 0
+        for run in text.split('?'):
+            if run:
+                runs.append((offset, run))
+            offset += len(run) + 1
+        anchor_offset, anchor = max(runs, key=lambda r: len(r[1])) if runs else (0, '')
+        checks = tuple(r for r in runs if r[0] != anchor_offset)
+        return super(Segment, cls).__new__(cls, gap, text, anchor_offset, anchor, checks,
+                                           _skip_table(anchor))
+
+
+class Pattern(namedtuple('Pattern', 'regex steps segments tail min_length required required_skip')):
+    """
+    A compiled regex.
+
+    steps is the tuple of steps made by splitting the regex by its leftmost
+    wildcard, then splitting the right side again, and so on. Only the last
+    step may have no wildcard, in which case its left side is a plain
+    substring to look for.
+
+    segments is the tuple of Segments of the regex for the greedy engine
+    and tail the number of '+' after the last one.
+
+    min_length is the least number of characters a match takes, and
+    required the longest literal without wildcards, which every match
+    contains, with required_skip its skip table. They let 'match' reject
+    most texts before running an engine.
+    """
+    __slots__ = ()
+
+    def __new__(cls, regex):
+        steps = []
+        rest = regex
+        while True:
+            split_regex = SplitRegexByLeftMostWildCard(rest)
+            steps.append(Step(split_regex.left, split_regex.wildcard, split_regex.right))
+            if split_regex.right is None:
+                break
+            rest = split_regex.right
+
+        segments = []
+        gap = 0
+        text = ''
+        for ch in regex:
+            if ch == '*' or ch == '+':
+                if text:
+                    segments.append(Segment(gap, text))
+                    gap = 0
+                    text = ''
+                if ch == '+':
+                    gap += 1
+            elif ch == '?' and not text:
+                # A '?' opening a segment is one more character of its gap,
+                # so that the match starts no earlier than it has to
+                gap += 1
+            else:
+                text += ch
+        if text:
+            segments.append(Segment(gap, text))
+            gap = 0
+
+        min_length = len(regex) - regex.count('*')
+        literals = regex.replace('*', '?').replace('+', '?').split('?')
+        required = max(literals, key=len)
+        return super(Pattern, cls).__new__(cls, regex, tuple(steps), tuple(segments), gap,
+                                           min_length, required, _skip_table(required))
+
+    def __getnewargs__(self):
+        return (self.regex,)
+
+
+CacheInfo = namedtuple('CacheInfo', 'hits misses maxsize currsize')
+
+_cache = OrderedDict()
+_cache_lock = Lock()
+_cache_hits = 0
+_cache_misses = 0
+
+def compile(regex):
+    """
+    Returns the Pattern for regex, reusing the patterns compiled for the
+    last CACHE_SIZE distinct regexes.
+    """
+    global _cache_hits, _cache_misses
+    if isinstance(regex, Pattern):
+        return regex
+    with _cache_lock:
+        try:
+            pattern = _cache.pop(regex)
+            _cache_hits += 1
+        except KeyError:
+            pattern = Pattern(regex)
+            _cache_misses += 1
+            if len(_cache) >= CACHE_SIZE:
+                _cache.popitem(last=False)
+        _cache[regex] = pattern
+    return pattern
+
+def cache_info():
+    """
+    Returns the hits, misses, maximum size and current size of the cache
+    """
+    return CacheInfo(_cache_hits, _cache_misses, CACHE_SIZE, len(_cache))
+
+def purge():
+    """
+    Clears the cache and its statistics
+    """
+    global _cache_hits, _cache_misses
+    with _cache_lock:
+        _cache.clear()
+        _cache_hits = 0
+        _cache_misses = 0
+
+# The tracer used by the engines when none is passed to 'match'
+_tracer = None
 
-def log(txt):
-    print indentation + txt
+def set_tracer(tracer):
+    """
+    Sets the tracer used when none is passed to 'match'.
+    A tracer is any callable taking (kind, depth, **fields), called for
+    every event of the search. With no tracer, which is the default,
+    tracing costs no more than a check for None.
 
-def match(regex, challenge, match_first_pos_only=False):
+    @return: The previous tracer
+    """
+    global _tracer
+    previous, _tracer = _tracer, tracer
+    return previous
+
+class TraceEvent(namedtuple('TraceEvent', 'kind depth fields')):
+    __slots__ = ()
+
+class CollectingTracer(object):
+    """
+    Tracer that keeps the events it receives
+    """
+    def __init__(self):
+        self.events = []
+
+    def __call__(self, kind, depth, **fields):
+        self.events.append(TraceEvent(kind, depth, fields))
+
+    def counts(self):
+        """
+        @return: A Counter of the events by kind
+        """
+        return Counter(event.kind for event in self.events)
+
+class StreamTracer(object):
+    """
+    Tracer that writes one line per event to a file, with the indentation
+    level indicating the recursion depth
+    """
+    def __init__(self, stream=None):
+        self.stream = stream
+
+    def __call__(self, kind, depth, **fields):
+        stream = self.stream or sys.stdout
+        stream.write('%s%s: %s\n' % ('    ' * depth, kind, ', '.join(
+                '%s=%r' % (name, fields[name]) for name in sorted(fields))))
+
+def match(regex, challenge, engine=None, tracer=None, pos=0, endpos=None):
     """
     Checks if a match exists.
-    Sets the result in the global 'result' variable.
-    Logs the status to the console, with the indentation level indicating the
-    recursion depth.
+    Keeps no state outside of the call, so it can run in several threads
+    at once.
 
-    @param regex: The regular expression
-    @param challenge: The text in which the expression is expected to match
-    @param match_first_pos_only: If True, indicates this is a recursive call from
-                                 the right hand side of a '?' wildcard
-    @return: Either the result or the position in the case of a plain substring match
+    @param regex: The regular expression, or a Pattern compiled from it
+    @param challenge: The text in which the expression is expected to match.
+                      Either a str, unicode, bytearray or mmap, which is
+                      searched in place without being copied, or a
+                      memoryview, which is copied once, see '_searchable'.
+    @param engine: 'backtracking' or 'greedy', DEFAULT_ENGINE if not given
+    @param tracer: The tracer to send events to, see 'set_tracer'
+    @param pos, endpos: Only look for a match within challenge[pos:endpos]
+    @return: True or False
 
     """
+    pattern = compile(regex)
+    if tracer is None:
+        tracer = _tracer
+    challenge = _searchable(challenge)
+    if endpos is None or endpos > len(challenge):
+        endpos = len(challenge)
+    if _rejects(pattern, challenge, pos, endpos, tracer):
+        return False
+    if (engine or DEFAULT_ENGINE) == 'greedy':
+        return _search_greedy(pattern, challenge, pos, endpos, tracer) is not None
+    return _match(pattern.steps, 0, challenge, pos, endpos, tracer=tracer)
 
-    global indentation
-    indentation = '%(indentation)s    ' % globals()
-    try:
-        # source the global result var
-        global result
-
-        split_regex = SplitRegexByLeftMostWildCard(regex)
-        log( 'Split Regex: ' + str(split_regex))
-        log( 'Challenge: ' + challenge)
-        log( 'Match First Position Only: %s' % match_first_pos_only)
-
-
-        if split_regex.wildcard:
-            while True:
-                find_next_left_match = False
-                log( "Searching for '%s' ..." % split_regex.left)
-                left_match_start = match(split_regex.left, challenge) if split_regex.left else 0
-                if (left_match_start is not 0) and (not left_match_start):
-                    log( "'%s' not found!" % split_regex.left)
-                    result = False
-                    return False
-                log( ("'%s' found ! start position: %s" % (split_regex.left, left_match_start)))
-                if (match_first_pos_only) and (left_match_start < 1):
-                    log( "Matched less than one character before '%s'! Need to look for more" % split_regex.left)
-                    match_first_pos_only = False      # Re-allow multiple iteration from the next iteration
-                    find_next_left_match = True
-                elif (match_first_pos_only) and (left_match_start > 1):
-                    log( "Matched more than one character before '%s'! No match!!" % split_regex.left)
-                    result = False
-                    return False
-                else:
-                    if split_regex.right:
-                        log( 'Finding right side match: %s' % split_regex.right)
-                        if split_regex.wildcard == '*':
-                            right_challenge_start = left_match_start + len(split_regex.left)
-                        elif split_regex.wildcard == '+' or split_regex.wildcard == '?':
-                            right_challenge_start = left_match_start + len(split_regex.left) + 1
-                        if (right_challenge_start >= len(challenge)):
-                            log( 'Not enough characters left to form right side challenge')
-                            result = False
-                            return False
-                        if (split_regex.wildcard == '?'):
-                            # Should iterate only once because it should match only one character
-                            match(split_regex.right, challenge[right_challenge_start:], match_first_pos_only=True)
-                        else:
-                            match(split_regex.right, challenge[right_challenge_start:])
-                        if result is True:
-                            log( 'Right side match found !')
-                            return True
-                        else:
-                            log( "Right side match not found. Need to look for the next '%s' match" % split_regex.left)
-                            find_next_left_match = True
-                    else:
-                        # This means the regex ends in the wildcard
-                        if split_regex.wildcard == '*':
-                            # Since the left side matched no need to check further as * matches 0 or more
-                            result = True
-                            return True
-                        elif split_regex.wildcard == '+' or split_regex.wildcard == '?':
-                            # the challenge should have at least one more character after left sequence
-                            if (left_match_start + len(split_regex.left)) >= len(challenge):
-                                result = False
-                                return False
-                            else:
-                                result = True
-                                return True
-                    if find_next_left_match:
-                        if not split_regex.left:
-                            log( "Regex starts with wildcard and right side doesn't match")
-                            result = False
-                            return False
-                        new_challenge_start = (left_match_start + len(split_regex.left))
-                        if new_challenge_start >= len(challenge):
-                            # In theory, we should never get here, so test coverage won't show this as executed
-                            log("Not enough characters in challenge to look for next '%s'" % split_regex.left)
-                            result = False
-                            return False
-                        challenge = challenge[new_challenge_start:]
-                        log( 'Finding next left match for new challenge: ' + challenge)
+class Span(namedtuple('Span', 'start end')):
+    """
+    The offsets of a match, which is challenge[start:end]
+    """
+    __slots__ = ()
+
+    def __len__(self):
+        return self.end - self.start
+
+def search(regex, challenge, tracer=None, pos=0, endpos=None):
+    """
+    Finds a match with the greedy engine, which is the one that tracks
+    where the match is. Its leading and trailing wildcards match as few
+    characters as they can, and it is the leftmost match that does. Both engines agree on whether there is one,
+    so this finds a match exactly when 'match' does.
+    Takes the same arguments as 'match'.
+
+    @return: The Span of the match, or None
+    """
+    pattern = compile(regex)
+    if tracer is None:
+        tracer = _tracer
+    challenge = _searchable(challenge)
+    if endpos is None or endpos > len(challenge):
+        endpos = len(challenge)
+    if _rejects(pattern, challenge, pos, endpos, tracer):
+        return None
+    span = _search_greedy(pattern, challenge, pos, endpos, tracer)
+    return Span(*span) if span is not None else None
+
+def finditer(regex, challenge, tracer=None, pos=0, endpos=None):
+    """
+    Finds all the matches that do not overlap, from left to right. Every
+    search starts at the end of the previous match, or one character
+    after it if that match was empty.
+
+    @return: A generator of the Span of every match
+    """
+    pattern = compile(regex)
+    if tracer is None:
+        tracer = _tracer
+    challenge = _searchable(challenge)
+    if endpos is None or endpos > len(challenge):
+        endpos = len(challenge)
+    if _rejects(pattern, challenge, pos, endpos, tracer):
+        return
+    while pos <= endpos:
+        span = _search_greedy(pattern, challenge, pos, endpos, tracer)
+        if span is None:
+            return
+        yield Span(*span)
+        pos = span[1] if span[1] > span[0] else span[1] + 1
+
+def _rejects(pattern, challenge, pos, endpos, tracer):
+    """
+    Checks if challenge[pos:endpos] is too short for pattern, or is missing
+    its required literal, so there is no need to run an engine
+    """
+    if endpos - pos < pattern.min_length:
+        if tracer is not None:
+            tracer('reject', 0, reason='challenge shorter than %s' % pattern.min_length)
+        return True
+    if pattern.required and _index(pattern.required, pattern.required_skip,
+                                   challenge, pos, endpos) < 0:
+        if tracer is not None:
+            tracer('reject', 0, reason='%r not found' % pattern.required)
+        return True
+    return False
+
+def _searchable(challenge):
+    """
+    Returns challenge, or the bytes of a memoryview, which has no find
+    method in Python 2. Searching the view itself by '_horspool' would
+    avoid the copy, but reading it a character at a time in Python is
+    about 60 times slower than copying it and searching in C.
+    """
+    if isinstance(challenge, memoryview):
+        return challenge.tobytes()
+    return challenge
+
+def _match(steps, index, challenge, start, end, match_first_pos_only=False, depth=1, tracer=None):
+    """
+    Checks if the part of the regex starting at steps[index] matches
+    challenge[start:end]. Works on the offsets, without slicing challenge.
+
+    @param match_first_pos_only: If True, the match must start at start, as
+                                 it does on the right hand side of a '?'
+                                 wildcard
+    @param depth: The recursion depth, for tracing
+    """
+
+    split_regex = steps[index]
+    if not split_regex.wildcard:
+        return _find(split_regex.left, challenge, start, end, match_first_pos_only, depth,
+                     tracer, split_regex.skip) >= 0
+
+    if tracer is not None:
+        tracer('split', depth, left=split_regex.left, wildcard=split_regex.wildcard,
+               right=split_regex.right, start=start, end=end,
+               match_first_pos_only=match_first_pos_only)
+
+    # The right side of a '?' must start right after the character it
+    # matches. A regex starting with '?' may match anywhere though, which is
+    # the same as its right side matching anywhere after the first character.
+    right_anchored = split_regex.wildcard == '?' and \
+            bool(split_regex.left or match_first_pos_only)
+
+    while True:
+        if split_regex.left:
+            left_match_start = _find(split_regex.left, challenge, start, end,
+                                     match_first_pos_only, depth=depth + 1,
+                                     tracer=tracer, skip=split_regex.skip)
         else:
-            # Base case where we should simply find if the string is a substring of another
-            for i in xrange(len(challenge)):
-                end_pos = i + len(split_regex.left)
-                if end_pos > len(challenge):
-                    result = False
-                    return False
-                if challenge[i : end_pos] == split_regex.left:
-                    result = True
-                    return i
-                if match_first_pos_only:
-                    result = False
-                    return False
-            result = False
+            left_match_start = start
+        if left_match_start < 0:
+            if tracer is not None:
+                tracer('fail', depth, reason='left side not found')
+            return False
+        right_challenge_start = left_match_start + len(split_regex.left)
+        if split_regex.wildcard != '*':
+            # '+' and '?' need at least one more character after the left side
+            right_challenge_start += 1
+        if right_challenge_start > end:
+            if tracer is not None:
+                tracer('fail', depth, reason='no characters left for the wildcard')
+            return False
+        if not split_regex.right:
+            # This means the regex ends in the wildcard, which fits in the
+            # characters left
+            return True
+        # The right side may match no characters, when it is a '*'
+        if _match(steps, index + 1, challenge, right_challenge_start, end,
+                  match_first_pos_only=right_anchored, depth=depth + 1, tracer=tracer):
+            return True
+        if match_first_pos_only or not split_regex.left:
+            # Any later start of the right side was already tried by the
+            # recursive call, unless it is anchored
+            if tracer is not None:
+                tracer('fail', depth, reason='right side does not match')
             return False
+        # Occurrences of the left side may overlap, so look from the next
+        # character on
+        start = left_match_start + 1
+        if tracer is not None:
+            tracer('backtrack', depth, left=split_regex.left, start=start)
+
+def _search_greedy(pattern, challenge, start, end, tracer=None):
+    """
+    Finds the leftmost match of pattern in challenge[start:end] in which
+    the wildcards before its first segment and after its last one match
+    as few characters as they can
+    @return: The (start, end) span of the match, or None
+    """
+    pos = start
+    match_start = None
+    for segment in pattern.segments:
+        if tracer is not None:
+            tracer('search', 1, literal=segment.text, start=pos + segment.gap)
+        pos = _find_segment(segment, challenge, pos + segment.gap, end)
+        if tracer is not None:
+            if pos < 0:
+                tracer('not_found', 1, literal=segment.text)
+            else:
+                tracer('found', 1, literal=segment.text, position=pos)
+        if pos < 0:
+            return None
+        if match_start is None:
+            match_start = pos - segment.gap
+        pos += len(segment.text)
+    if match_start is None:
+        match_start = start
+    pos += pattern.tail
+    if pos > end:
+        return None
+    return match_start, pos
+
+def _find_segment(segment, challenge, start, end):
+    """
+    Finds the leftmost occurrence of segment in challenge[start:end]
+    @return: The position of the segment, or -1
+    """
+    length = len(segment.text)
+    offset = segment.anchor_offset
+    # The anchor must leave room for the rest of the segment on both sides
+    last = end - length + offset + len(segment.anchor)
+    pos = start + offset
+    while True:
+        pos = _index(segment.anchor, segment.skip, challenge, pos, last)
+        if pos < 0:
+            return -1
+        segment_start = pos - offset
+        for check_offset, run in segment.checks:
+            run_start = segment_start + check_offset
+            if _index(run, None, challenge, run_start, run_start + len(run)) != run_start:
+                break
+        else:
+            return segment_start
+        pos += 1
+
+def _index(literal, skip, challenge, start, end):
+    """
+    Finds literal in challenge[start:end] with the find method of the
+    challenge, which searches in C with its own skip tables, or with
+    '_horspool' if it has none
+    @return: The position of literal, or -1
+    """
+    try:
+        return challenge.find(literal, start, end)
+    except AttributeError:
+        return _horspool(literal, skip, challenge, start, end)
+
+def _horspool(literal, skip, challenge, start, end):
+    """
+    Boyer-Moore-Horspool search of literal in challenge[start:end], for any
+    sequence of characters. Compares the last character of literal first
+    and, on a mismatch, moves by the skip table of the character read.
+
+    @param skip: The skip table of literal, computed if None
+    @return: The position of literal, or -1
+    """
+    length = len(literal)
+    if not length:
+        return start if start <= end else -1
+    if skip is None:
+        skip = _skip_table(literal)
+    last = length - 1
+    last_char = literal[last]
+    i = start + last
+    while i < end:
+        ch = challenge[i]
+        if ch == last_char:
+            j = i - last
+            k = 0
+            while k < last and challenge[j + k] == literal[k]:
+                k += 1
+            if k == last:
+                return j
+        i += skip.get(ch, length)
+    return -1
+
+def _find(literal, challenge, start, end, match_first_pos_only=False, depth=1,
+          tracer=None, skip=None):
+    """
+    Base case where we should simply find if the string is a substring of another
+    @param skip: The skip table of literal, see '_horspool'
+    @return: The position of literal in challenge[start:end], or -1
+    """
+
+    if tracer is not None:
+        tracer('search', depth, literal=literal, start=start, end=end,
+               match_first_pos_only=match_first_pos_only)
+    position = -1
+    # An empty window still holds the empty literal
+    if start <= end:
+        if match_first_pos_only:
+            # Only a match right at start counts
+            end = min(end, start + len(literal))
+        position = _index(literal, skip, challenge, start, end)
+        if match_first_pos_only and position != start:
+            position = -1
+    if tracer is not None:
+        if position < 0:
+            tracer('not_found', depth, literal=literal)
+        else:
+            tracer('found', depth, literal=literal, position=position)
+    return position
+
+
+class _Matcher(object):
+    """
+    Picklable callable that matches a regex against one text, for the
+    workers of 'match_many'
+    """
+    def __init__(self, regex, engine):
+        self.regex = regex
+        self.engine = engine
+
+    def __call__(self, challenge):
+        return match(self.regex, challenge, engine=self.engine)
+
+def match_many(regex, challenges, workers=1, processes=False, engine=None, chunksize=None):
+    """
+    Checks if a match exists in each of the challenges.
+
+    @param workers: The number of threads, or processes, to spread the
+                    challenges over. Threads only run one match at a time
+                    because of the GIL, so use processes to use every core.
+    @param processes: If True, use a pool of processes instead of threads
+    @param chunksize: The number of challenges handed to a worker at a time
+    @return: The list of results, in the order of the challenges
+    """
+    pattern = compile(regex)
+    if workers <= 1:
+        return [match(pattern, challenge, engine=engine) for challenge in challenges]
+    challenges = list(challenges)
+    if chunksize is None:
+        chunksize = max(1, len(challenges) // (workers * 4))
+    pool = Pool(workers) if processes else ThreadPool(workers)
+    try:
+        # Workers get the regex rather than the pattern and compile it into
+        # their own cache
+        return pool.map(_Matcher(pattern.regex, engine), challenges, chunksize)
     finally:
-        indentation = indentation[4:]
+        pool.close()
+        pool.join()
+
+
+class PatternSet(object):
+    """
+    Set of patterns to match texts against at once.
 
+    The required literal of every pattern, see 'Pattern', goes into an
+    Aho-Corasick automaton, which finds all of them in a single scan of the
+    text. Only the patterns whose literal is found, and those without one,
+    are then checked with 'match', so the cost grows with the length of the
+    text rather than the number of patterns.
+    """
+    def __init__(self, regexes=(), engine=None):
+        """
+        @param regexes: The patterns to add, with their positions as ids
+        @param engine: The engine that checks candidates, see 'match'
+        """
+        self.engine = engine
+        self.patterns = []
+        # Automaton, rebuilt on the next match after patterns are added
+        self.goto = None
+        self.fail = None
+        self.out = None
+        self.unindexed = None
+        for regex in regexes:
+            self.add(regex)
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def add(self, regex, pattern_id=None):
+        """
+        Adds a pattern. It is compiled without going through the cache,
+        which is too small to hold a large set.
+
+        @param pattern_id: The id reported for the pattern when it matches,
+                           its position in the set if None
+        @return: The id of the pattern
+        """
+        if pattern_id is None:
+            pattern_id = len(self.patterns)
+        if not isinstance(regex, Pattern):
+            regex = Pattern(regex)
+        self.patterns.append((pattern_id, regex))
+        self.goto = None
+        return pattern_id
+
+    def _build(self):
+        """
+        Builds the trie of the required literals, then sets the failure
+        link of every state to the state of its longest proper suffix, in
+        breadth first order, merging the outputs along the way
+        """
+        goto = [{}]
+        out = [[]]
+        unindexed = []
+        for index, (pattern_id, pattern) in enumerate(self.patterns):
+            if not pattern.required:
+                unindexed.append(index)
+                continue
+            state = 0
+            for ch in pattern.required:
+                next_state = goto[state].get(ch)
+                if next_state is None:
+                    next_state = goto[state][ch] = len(goto)
+                    goto.append({})
+                    out.append([])
+                state = next_state
+            out[state].append(index)
+
+        fail = [0] * len(goto)
+        queue = list(goto[0].values())
+        for state in queue:
+            for ch, next_state in goto[state].iteritems():
+                queue.append(next_state)
+                suffix = fail[state]
+                while suffix and ch not in goto[suffix]:
+                    suffix = fail[suffix]
+                fail[next_state] = goto[suffix].get(ch, 0)
+                out[next_state] = out[next_state] + out[fail[next_state]]
+        self.goto, self.fail, self.out, self.unindexed = goto, fail, out, unindexed
+
+    def candidates(self, challenge, pos=0, endpos=None):
+        """
+        @return: The sorted indexes in the set of the patterns whose
+                 required literal is in challenge[pos:endpos], along with
+                 those without one
+        """
+        if self.goto is None:
+            self._build()
+        goto, fail, out = self.goto, self.fail, self.out
+        challenge = _searchable(challenge)
+        if isinstance(challenge, bytearray):
+            # Indexes into a buffer of a bytearray give characters, not ints
+            challenge = buffer(challenge)
+        if endpos is None or endpos > len(challenge):
+            endpos = len(challenge)
+        found = set(self.unindexed)
+        state = 0
+        for i in xrange(pos, endpos):
+            ch = challenge[i]
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if out[state]:
+                found.update(out[state])
+        return sorted(found)
 
+    def match(self, challenge, pos=0, endpos=None, tracer=None):
+        """
+        @return: The list of ids of the patterns that match challenge, in
+                 the order the patterns were added
+        """
+        patterns = self.patterns
+        # Copy a memoryview once for all the candidates
+        challenge = _searchable(challenge)
+        return [patterns[index][0] for index in self.candidates(challenge, pos, endpos)
+                if match(patterns[index][1], challenge, self.engine, tracer, pos, endpos)]
 
-item = None
 
-def test():
-    global item
+GrepMatch = namedtuple('GrepMatch', 'number offset line')
+
+def grep(regex, stream, engine=None, separator='\n', chunk_size=CHUNK_SIZE):
+    """
+    Matches regex against every line of stream, reading it in chunks.
+    Lines are matched in place within the chunks, and only copied when
+    they match or run over into the next chunk, so memory use depends on
+    the length of the lines but not of the stream.
+
+    @param stream: Any file like object with a read method, like sys.stdin
+    @param separator: The single character ending the lines, or records
+    @return: A generator of the GrepMatch of every matching line, with its
+             number starting from 1 and its offset in the stream
+    """
+    pattern = compile(regex)
+    number = 0
+    offset = 0
+    pieces = []
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        start = 0
+        end = chunk.find(separator)
+        while end >= 0:
+            number += 1
+            if pieces:
+                pieces.append(chunk[start:end])
+                line = ''.join(pieces)
+                pieces = []
+                if match(pattern, line, engine):
+                    yield GrepMatch(number, offset, line)
+                offset += len(line) + 1
+            else:
+                if match(pattern, chunk, engine, pos=start, endpos=end):
+                    yield GrepMatch(number, offset, chunk[start:end])
+                offset += end - start + 1
+            start = end + 1
+            end = chunk.find(separator, start)
+        if start < len(chunk):
+            pieces.append(chunk[start:])
+    if pieces:
+        line = ''.join(pieces)
+        if match(pattern, line, engine):
+            yield GrepMatch(number + 1, offset, line)
+
+def grep_file(regex, path, engine=None, separator='\n', use_mmap=True):
+    """
+    Matches regex against every line of the file at path, like 'grep'.
+    The file is mapped to memory, unless use_mmap is False, and matched
+    in place, without being read into strings.
+
+    @return: A generator of the GrepMatch of every matching line
+    """
+    with open(path, 'rb') as f:
+        if not use_mmap:
+            for found in grep(regex, f, engine, separator):
+                yield found
+            return
+        if not os.fstat(f.fileno()).st_size:
+            # Empty files cannot be mapped
+            return
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            pattern = compile(regex)
+            number = 0
+            start = 0
+            size = len(mapped)
+            while start < size:
+                end = mapped.find(separator, start)
+                if end < 0:
+                    end = size
+                number += 1
+                if match(pattern, mapped, engine, pos=start, endpos=end):
+                    yield GrepMatch(number, start, mapped[start:end])
+                start = end + 1
+        finally:
+            mapped.close()
+
+def grep_main(args, stdout=None):
+    """
+    Runs the grep command line, see the module docstring
+    @return: The exit status, 0 if any line matched and 1 otherwise, like grep
+    """
+    parser = argparse.ArgumentParser(
+            prog='basic_regex.py grep',
+            description='Print the lines of the files, or stdin, that match REGEX')
+    parser.add_argument('regex', metavar='REGEX')
+    parser.add_argument('files', metavar='FILE', nargs='*',
+                        help="the files to search, '-' for stdin, which is the default")
+    parser.add_argument('--engine', choices=['backtracking', 'greedy'], default=None)
+    parser.add_argument('-z', '--null-data', action='store_true',
+                        help='records end with a NUL character instead of a newline')
+    parser.add_argument('--no-mmap', action='store_true',
+                        help='read the files in chunks instead of mapping them to memory')
+    parser.add_argument('-c', '--count', action='store_true',
+                        help='only print the number of matching lines')
+    options = parser.parse_args(args)
+    stdout = stdout or sys.stdout
+    separator = '\0' if options.null_data else '\n'
+    files = options.files or ['-']
+    matched = False
+    for path in files:
+        if path == '-':
+            found = grep(options.regex, sys.stdin, options.engine, separator)
+        else:
+            found = grep_file(options.regex, path, options.engine, separator,
+                              use_mmap=not options.no_mmap)
+        prefix = '%s:' % path if len(files) > 1 else ''
+        count = 0
+        for number, offset, line in found:
+            count += 1
+            if not options.count:
+                stdout.write('%s%s:%s:%s\n' % (prefix, number, offset, line))
+        if options.count:
+            stdout.write('%s%s\n' % (prefix, count))
+        matched = matched or count > 0
+    return 0 if matched else 1
+
+
+def test(engine=None):
     num_passed = 0
     num_failed = 0
     for item in TESTS:
         print '-----------------------------------------------------------'
         print 'Starting Test: %s' % item
         print
+        outcome = []
         time = timeit.timeit(
-                'match(item[0], item[1])',
-                setup="from __main__ import *",
+                lambda: outcome.append(match(item[0], item[1], engine=engine)),
                 number=1)
-        if result is item[2]:
+        if outcome[0] is item[2]:
             verdict = '\033[102m' + "PASS" + '\033[0m'
             num_passed += 1
         else:
@@ -269,10 +991,422 @@ def test():
         msg = '\033[91m' + "Failures encountered!!"
     else:
         msg = '\033[92m' + "Success!!"
-    print '\033[1m%s Test Score: %s/%s\033[0m' % (
-            msg, num_passed, num_passed+num_failed)
+    print '\033[1m%s Test Score: %s/%s (engine: %s)\033[0m' % (
+            msg, num_passed, num_passed+num_failed, engine or DEFAULT_ENGINE)
     print
+    return num_failed == 0
+
+
+def test_compile():
+    """
+    Tests compiling patterns and the LRU cache
+    """
+    purge()
+    pattern = compile('a*b?c')
+    assert pattern.regex == 'a*b?c'
+    assert [step[:3] for step in pattern.steps] == [('a', '*', 'b?c'), ('b', '?', 'c'), ('c', None, None)]
+    assert [step[:3] for step in compile('*').steps] == [('', '*', None)]
+    assert [step[:3] for step in compile('a**').steps] == [('a', '*', '*'), ('', '*', None)]
+    assert [step[:3] for step in compile('abc').steps] == [('abc', None, None)]
+    assert compile('a*b?c') is pattern
+    assert compile(pattern) is pattern
+    assert cache_info() == (1, 4, CACHE_SIZE, 4)
+    # Filling the cache evicts the least recently used patterns first
+    compile('*')
+    for i in xrange(CACHE_SIZE - 2):
+        compile('x%s*' % i)
+    assert cache_info().currsize == CACHE_SIZE
+    assert 'a*b?c' in _cache and '*' in _cache
+    assert 'a**' not in _cache and 'abc' not in _cache
+    assert match(pattern, 'xxabxcd') is True
+    purge()
+    assert cache_info() == (0, 0, CACHE_SIZE, 0)
+
+
+def test_greedy():
+    """
+    Tests the greedy engine beyond the 'TESTS' list
+    """
+    pattern = compile('+a?c*d++')
+    assert [segment.text for segment in pattern.segments] == ['a?c', 'd']
+    assert [segment.gap for segment in pattern.segments] == [1, 0]
+    assert pattern.tail == 2
+    assert pattern.segments[0].anchor == 'a'
+    assert pattern.segments[0].checks == ((2, 'c'),)
+    assert _search_greedy(pattern, 'xabcyydzz', 0, 9) == (0, 9)
+    assert _search_greedy(pattern, 'abcyydzz', 0, 8) is None
+    assert _search_greedy(compile('?'), 'abc', 0, 3) == (0, 1)
+    assert _search_greedy(compile('??'), 'a', 0, 1) is None
+    assert _search_greedy(compile(''), '', 0, 0) == (0, 0)
+    assert _search_greedy(compile('a?c'), 'abxabc', 0, 6) == (3, 6)
+    assert _search_greedy(compile('b*'), 'abcb', 0, 4) == (1, 2)
+    # Many stars against a long near miss, which sends the backtracking
+    # engine through every combination of 'a' positions
+    assert match('a*' * 20 + 'b', 'a' * 5000, engine='greedy') is False
+    assert match('a*' * 20 + 'b', 'a' * 5000 + 'b', engine='greedy') is True
+
+
+def test_engines():
+    """
+    Checks that both engines agree with each other, and with the same
+    search by the re module, on random regexes and windows of the text
+    """
+    rand = random.Random(11)
+    for i in xrange(5000):
+        regex = ''.join(rand.choice('ab*+?') for j in xrange(rand.randint(0, 7)))
+        challenge = ''.join(rand.choice('abc') for j in xrange(rand.randint(0, 10)))
+        pos = rand.randint(0, len(challenge))
+        endpos = rand.randint(pos, len(challenge))
+        equivalent = re.escape(regex).replace('\\*', '.*').replace('\\+', '.+')\
+                .replace('\\?', '.')
+        expected = re.compile(equivalent, re.DOTALL).search(challenge, pos, endpos) is not None
+        for engine in ['backtracking', 'greedy']:
+            assert match(regex, challenge, engine=engine, pos=pos, endpos=endpos) is expected, \
+                    (regex, challenge, pos, endpos, engine)
+
+
+def test_concurrency():
+    """
+    Tests matching from several threads and processes at once
+    """
+    regexes = [item[0] for item in TESTS]
+    challenges = [item[1] for item in TESTS]
+    expected = [item[2] for item in TESTS]
+    for engine in ['backtracking', 'greedy']:
+        results = [None] * len(TESTS)
+        def run(i):
+            results[i] = match(regexes[i], challenges[i], engine=engine)
+        pool = ThreadPool(8)
+        pool.map(run, range(len(TESTS)))
+        pool.close()
+        pool.join()
+        assert results == expected
+
+    texts = ['%s-%s' % ('abc' if i % 3 else 'xyz', i) for i in xrange(100)]
+    expected = [i % 3 != 0 for i in xrange(100)]
+    assert match_many('a?c-+', texts) == expected
+    assert match_many('a?c-+', texts, workers=4, engine='greedy') == expected
+    assert match_many(compile('a?c-+'), texts, workers=2, processes=True, engine='greedy') == expected
+    assert match_many('a?c-+', iter([]), workers=2) == []
+    assert pickle.loads(pickle.dumps(compile('a*b'))) == compile('a*b')
+
+
+class UnsliceableStr(str):
+    """
+    String that cannot be sliced or indexed, to check nothing gets copied
+    """
+    def __getitem__(self, index):
+        raise AssertionError('Challenge was indexed')
+
+    def __getslice__(self, i, j):
+        raise AssertionError('Challenge was sliced')
+
+
+def test_buffers():
+    """
+    Tests matching against buffers and within offsets, without copying
+    """
+    for engine in ['backtracking', 'greedy']:
+        for regex, challenge, expected in TESTS:
+            for buf in [UnsliceableStr(challenge), bytearray(challenge),
+                        memoryview(challenge), unicode(challenge), array('c', challenge)]:
+                assert match(regex, buf, engine=engine) is expected
+            # The same challenge in the middle of a larger buffer
+            padded = '\0' * 3 + challenge + '\0' * 3
+            assert match(regex, padded, engine=engine,
+                         pos=3, endpos=3 + len(challenge)) is expected
+
+        mapped_file = tempfile.TemporaryFile()
+        try:
+            mapped_file.write('x' * 100000 + 'lmnoabcdef' + 'y' * 100000)
+            mapped_file.flush()
+            mapped = mmap.mmap(mapped_file.fileno(), 0, access=mmap.ACCESS_READ)
+            assert match('*lmno?bc+f*', mapped, engine=engine) is True
+            assert match('*lmno?bc+g*', mapped, engine=engine) is False
+            assert match('lmno', mapped, engine=engine, endpos=100003) is False
+            mapped.close()
+        finally:
+            mapped_file.close()
+
+    # A memoryview is copied once per call, however many patterns it meets
+    view = memoryview(bytearray('x' * 1000 + 'lmnoabcdef' + 'y' * 1000))
+    assert search('lmno?bc', view) == (1000, 1007)
+    assert list(finditer('y+y', view, pos=2000)) == [(2000, 2003), (2003, 2006), (2006, 2009)]
+    copies = []
+    def searchable(challenge):
+        copies.append(challenge)
+        return searchable.original(challenge)
+    searchable.original = _searchable
+    globals()['_searchable'] = searchable
+    try:
+        assert PatternSet(['lmno*f', 'lmnox', '*bcd', 'x?x']).match(view) == [0, 2, 3]
+    finally:
+        globals()['_searchable'] = searchable.original
+    assert [type(challenge) for challenge in copies].count(memoryview) == 1
+
+
+def test_prefilter():
+    """
+    Tests the rejection of texts before the engines run, and checks that it
+    never rejects a text that matches
+    """
+    pattern = compile('ab+?cde*f')
+    assert pattern.min_length == 8
+    assert pattern.required == 'cde'
+    assert compile('*').min_length == 0 and compile('*').required == ''
+    tracer = CollectingTracer()
+    assert match(pattern, 'abxxcdf', tracer=tracer) is False
+    assert tracer.events == [('reject', 0, {'reason': 'challenge shorter than 8'})]
+    tracer = CollectingTracer()
+    assert match(pattern, 'abxxcdfxxxf', tracer=tracer) is False
+    assert tracer.events == [('reject', 0, {'reason': "'cde' not found"})]
+    assert match(pattern, 'xxcdeabxxcdeff', pos=2, endpos=12) is False
+    assert match(pattern, 'xxcdeabxxcdeff', pos=5) is True
+
+    rand = random.Random(16)
+    for i in xrange(3000):
+        regex = ''.join(rand.choice('ab*+?') for j in xrange(rand.randint(1, 6)))
+        challenge = ''.join(rand.choice('ab') for j in xrange(rand.randint(0, 8)))
+        pattern = Pattern(regex)
+        expected = _match(pattern.steps, 0, challenge, 0, len(challenge))
+        assert match(pattern, challenge) is expected
+        expected = _search_greedy(pattern, challenge, 0, len(challenge)) is not None
+        assert match(pattern, challenge, engine='greedy') is expected
+
+
+def test_pattern_set():
+    """
+    Tests matching a text against a set of patterns
+    """
+    patterns = PatternSet(['he*s', '*', 'she', 'his', 'hers+', 'x+y'])
+    assert patterns.add('s?e', pattern_id='s-e') == 's-e'
+    assert len(patterns) == 7
+    assert patterns.candidates('ushers') == [0, 1, 2, 4, 6]
+    assert patterns.match('ushers') == [0, 1, 2, 's-e']
+    assert patterns.match('ushers', pos=2) == [0, 1]
+    assert patterns.match(bytearray('xxy his')) == [1, 3, 5]
+    assert patterns.match('') == [1]
+    patterns.add('sh*r')
+    assert patterns.match(array('c', 'ushers')) == [0, 1, 2, 's-e', 7]
+
+    rand = random.Random(17)
+    regexes = [''.join(rand.choice('abc*+?') for j in xrange(rand.randint(1, 6)))
+               for i in xrange(300)]
+    for engine in ['backtracking', 'greedy']:
+        patterns = PatternSet(regexes, engine=engine)
+        for i in xrange(100):
+            challenge = ''.join(rand.choice('abc') for j in xrange(rand.randint(0, 12)))
+            assert patterns.match(challenge) == [
+                    index for index, regex in enumerate(regexes)
+                    if match(regex, challenge, engine=engine)]
+
+
+def test_grep():
+    """
+    Tests matching the lines of streams and files
+    """
+    text = 'first line\nsecond\n\nlong %s line\nlast line' % ('x' * 50)
+    expected = [(1, 0, 'first line'), (4, 19, 'long %s line' % ('x' * 50)),
+                (5, 80, 'last line')]
+    for chunk_size in [1, 3, 7, CHUNK_SIZE]:
+        assert list(grep('*line', StringIO(text), chunk_size=chunk_size)) == expected
+        assert list(grep('*line', StringIO(text + '\n'), chunk_size=chunk_size)) == expected
+        assert list(grep('?', StringIO(text.replace('\n', '\0')), separator='\0',
+                         chunk_size=chunk_size))[1] == (2, 11, 'second')
+    assert list(grep('*', StringIO(''))) == []
+
+    temp_file = tempfile.NamedTemporaryFile(delete=False)
+    temp_file.close()
+    path = temp_file.name
+    try:
+        for contents in ['', text]:
+            with open(path, 'wb') as f:
+                f.write(contents)
+            for use_mmap in [True, False]:
+                assert list(grep_file('*line', path, use_mmap=use_mmap)) == expected[:len(contents) and 3]
+        out = StringIO()
+        assert grep_main(['--engine', 'greedy', 'l?ne', path], stdout=out) == 0
+        assert out.getvalue().splitlines() == ['%s:%s:%s' % found for found in expected]
+        out = StringIO()
+        assert grep_main(['-c', 'se+d', path, path], stdout=out) == 0
+        assert out.getvalue() == '%s:1\n%s:1\n' % (path, path)
+        assert grep_main(['-c', 'nothing', path], stdout=StringIO()) == 1
+    finally:
+        os.remove(path)
+
+
+def test_spans():
+    """
+    Tests the spans found by search and finditer against the TESTS table
+    """
+    for regex, challenge, expected in TESTS:
+        span = search(regex, challenge)
+        assert (span is not None) is expected
+        spans = list(finditer(regex, challenge))
+        assert bool(spans) is expected
+        if span is None:
+            continue
+        assert spans[0] == span
+        for previous, current in zip(spans, spans[1:]):
+            assert previous.end <= current.start and previous != current
+        for start, end in spans:
+            # Every span is a match on its own, and the shortest one from its start
+            assert match(regex, challenge, engine='greedy', pos=start, endpos=end)
+            if end > start:
+                assert not match(regex, challenge, engine='greedy', pos=start, endpos=end - 1)
+
+    assert search('b?d', 'abcdbxd') == (1, 4)
+    assert len(search('b?d', 'abcdbxd')) == 3
+    assert list(finditer('b?d', 'abcdbxd')) == [(1, 4), (4, 7)]
+    assert list(finditer('b?d', 'abcdbxd', pos=2)) == [(4, 7)]
+    assert list(finditer('+b', bytearray('abbbcb'))) == [(0, 2), (2, 4), (4, 6)]
+    assert list(finditer('a*', 'aa')) == [(0, 1), (1, 2)]
+    assert list(finditer('*', 'ab')) == [(0, 0), (1, 1), (2, 2)]
+    assert list(finditer('x', 'ab')) == []
+    assert search('?a', 'a') is None
+    # Leading and trailing wildcards match as few characters as they can
+    assert search('+a', 'xxa') == (1, 3)
+    assert search('*+a', 'xxa') == (1, 3)
+    assert search('?+a', 'xxxa') == (1, 4)
+    assert search('a?+', 'axxx') == (0, 3)
+    assert search('a*', 'ab') == (0, 1)
+    assert search('', 'ab', pos=2) == (2, 2)
+    assert match('', 'ab', pos=2) is True
+
+    # Every API finds a match in the same texts, whatever the engine
+    rand = random.Random(19)
+    for i in xrange(500):
+        regex = ''.join(rand.choice('ab*+?') for j in xrange(rand.randint(1, 6)))
+        challenge = ''.join(rand.choice('abc') for j in xrange(rand.randint(0, 8)))
+        expected = search(regex, challenge) is not None
+        assert bool(list(finditer(regex, challenge))) is expected
+        for engine in ['backtracking', 'greedy']:
+            assert match(regex, challenge, engine=engine) is expected, (regex, challenge)
+            assert (PatternSet([regex], engine=engine).match(challenge) == [0]) is expected
+            lines = list(grep(regex, StringIO(challenge + '\n'), engine=engine))
+            assert bool(lines) is expected
+
+        # The span is the leftmost and shortest match once the wildcards at
+        # either end are narrowed to as few characters as they can match
+        body = regex.lstrip('*+?')
+        core = body.rstrip('*+?')
+        lead = regex[:len(regex) - len(body)]
+        trail = body[len(core):]
+        narrow = ('?' * (len(lead) - lead.count('*')) + core +
+                  '?' * (len(trail) - trail.count('*')))
+        equivalent = re.compile(re.escape(narrow).replace('\\*', '.*').replace('\\+', '.+')
+                                .replace('\\?', '.') + r'\Z', re.DOTALL)
+        spans = [(start, end) for start in xrange(len(challenge) + 1)
+                 for end in xrange(start, len(challenge) + 1)
+                 if equivalent.match(challenge[:end], start)]
+        assert search(regex, challenge) == (spans[0] if spans else None), (regex, challenge)
+
+
+def test_horspool():
+    """
+    Tests the Horspool search against str.find
+    """
+    assert _skip_table('abcab') == {'a': 1, 'b': 3, 'c': 2}
+    assert Pattern('abcab*').steps[0].skip == _skip_table('abcab')
+    rand = random.Random(15)
+    for i in xrange(2000):
+        text = ''.join(rand.choice('abc') for j in xrange(rand.randint(0, 30)))
+        literal = ''.join(rand.choice('abc') for j in xrange(rand.randint(0, 5)))
+        start = rand.randint(0, len(text))
+        end = rand.randint(start, len(text))
+        skip = _skip_table(literal) if rand.random() < 0.5 else None
+        assert _horspool(literal, skip, array('c', text), start, end) == text.find(literal, start, end)
+
+
+def search_benchmark(n=1000000):
+    """
+    Prints the time taken to find long literals at the end of a text of
+    n characters, by the per character loop the engine used to run, by
+    '_horspool' and by str.find, then by both engines
+    """
+    def scan(literal, challenge):
+        for i in xrange(len(challenge)):
+            end_pos = i + len(literal)
+            if end_pos > len(challenge):
+                break
+            if challenge[i : end_pos] == literal:
+                return i
+        return -1
+
+    rand = random.Random(15)
+    text = ''.join(rand.choice('abcdefgh') for i in xrange(n))
+    literal = 'x' + text[n // 2 : n // 2 + 63]
+    text += literal
+    skip = _skip_table(literal)
+    chars = array('c', text)
+    regex = '%s*%s' % (literal[:32], literal[32:])
+
+    def best(func):
+        return min(timeit.repeat(func, number=1, repeat=3))
+
+    print 'Finding a %s character literal in %s characters:' % (len(literal), len(text))
+    print '    %-32s %8.4fs' % ('per character slicing', best(lambda: scan(literal, text)))
+    print '    %-32s %8.4fs' % ('horspool on array', best(lambda: _horspool(literal, skip, chars, 0, len(text))))
+    print '    %-32s %8.4fs' % ('str.find', best(lambda: _index(literal, skip, text, 0, len(text))))
+    for engine in ['backtracking', 'greedy']:
+        print '    %-32s %8.4fs' % ('match %s on str' % engine,
+                                    best(lambda: match(regex, text, engine=engine)))
+        print '    %-32s %8.4fs' % ('match %s on array' % engine,
+                                    best(lambda: match(regex, chars, engine=engine)))
+
+
+def test_tracing():
+    """
+    Tests the events sent to tracers
+    """
+    tracer = CollectingTracer()
+    assert match('a?c', 'abxabc', tracer=tracer) is True
+    assert [event.kind for event in tracer.events] == [
+            'split', 'search', 'found', 'search', 'not_found',
+            'backtrack', 'search', 'found', 'search', 'found']
+    assert tracer.events[7] == ('found', 2, {'literal': 'a', 'position': 3})
+    assert tracer.events[5] == ('backtrack', 1, {'left': 'a', 'start': 1})
+    assert tracer.counts()['found'] == 3
+
+    tracer = CollectingTracer()
+    assert match('a?c*z', 'abcd', engine='greedy', tracer=tracer) is False
+    assert tracer.counts() == {'search': 2, 'found': 1, 'not_found': 1}
+
+    # The module level tracer is used when none is given
+    tracer = CollectingTracer()
+    previous = set_tracer(tracer)
+    try:
+        match('a*', 'a')
+    finally:
+        assert set_tracer(previous) is tracer
+    assert len(tracer.events) == 3
+    match('a*', 'a')
+    assert len(tracer.events) == 3
+
+    stream = StringIO()
+    match('a*', 'a', tracer=StreamTracer(stream))
+    assert stream.getvalue().splitlines()[2] == "        found: literal='a', position=0"
 
 
 if __name__ == "__main__":
-    test()
+    if sys.argv[1:2] == ['grep']:
+        sys.exit(grep_main(sys.argv[2:]))
+    test_compile()
+    test_greedy()
+    test_engines()
+    test_concurrency()
+    test_tracing()
+    test_buffers()
+    test_horspool()
+    test_prefilter()
+    test_pattern_set()
+    test_grep()
+    test_spans()
+    if '--bench' in sys.argv:
+        args = sys.argv[sys.argv.index('--bench') + 1:]
+        search_benchmark(*[int(arg) for arg in args[:1] if arg.isdigit()])
+    if '--trace' in sys.argv:
+        set_tracer(StreamTracer())
+    passed = test(engine='backtracking')
+    passed = test(engine='greedy') and passed
+    sys.exit(0 if passed else 1)
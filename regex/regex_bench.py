@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+
+"""
+Benchmark suite for basic_regex.
+
+Every workload builds a regex and a list of texts for a given size:
+    near_miss    Two '*' before a literal that only occurs too early,
+                 so the backtracking engine has to try every split.
+    many_stars   A regex of 16 single characters between '*', spread
+                 evenly over random texts of other characters.
+    long_literal A 64 character literal split by one '*', hidden at the
+                 end of a random text.
+    log_lines    Random log lines adding up to the size, of which few
+                 match.
+
+Every engine runs every workload at every size with tracing off, and the
+matches per second of the best of several runs are reported, along with
+the scaling exponent of the time per match between consecutive sizes
+(1 for linear, 2 for quadratic). A run over its time budget is stopped
+and recorded as timed out, and the larger sizes are skipped for that
+engine.
+
+Results can be written to a JSON file, and compared with the results of
+a previous run to catch regressions:
+    regex_bench.py --output before.json
+    regex_bench.py --compare before.json --threshold 1.25
+
+"""
+
+__author__ = 'Orko Garai (orko.garai@gmail.com)'
+
+from math import log
+import argparse
+import json
+import platform
+import random
+import signal
+import sys
+import timeit
+
+import basic_regex
+
+ENGINES = ['backtracking', 'greedy']
+
+DEFAULT_SIZES = [100, 1000, 10000, 100000]
+
+LOG_LEVELS = ['DEBUG', 'INFO', 'INFO', 'INFO', 'WARNING', 'ERROR']
+
+LOG_MESSAGES = ['connection accepted from %s', 'request served in %sms',
+                'cache miss for key %s', 'retrying job %s',
+                'timeout after %sms waiting for lock']
+
+def near_miss(size, rand):
+    text = 'ab' + 'a' * (size - 2)
+    return 'a*a*ab', [text]
+
+def many_stars(size, rand):
+    letters = [rand.choice('xyz') for i in xrange(16)]
+    text = [rand.choice('abcdefgh') for i in xrange(size)]
+    for i, letter in enumerate(letters):
+        text[(2 * i + 1) * size // 32] = letter
+    return '*'.join(letters), [''.join(text)]
+
+def long_literal(size, rand):
+    text = ''.join(rand.choice('abcdefgh') for i in xrange(size))
+    literal = ''.join(rand.choice('abcdefghxyz') for i in xrange(64))
+    return literal[:32] + '*' + literal[32:], [text + literal]
+
+def log_lines(size, rand):
+    texts = []
+    length = 0
+    while length < size:
+        message = rand.choice(LOG_MESSAGES) % rand.randint(1, 99999)
+        line = '2016-%02d-%02d %02d:%02d:%02d %s worker-%s: %s' % (
+                rand.randint(1, 12), rand.randint(1, 28), rand.randint(0, 23),
+                rand.randint(0, 59), rand.randint(0, 59), rand.choice(LOG_LEVELS),
+                rand.randint(1, 16), message)
+        texts.append(line)
+        length += len(line) + 1
+    return '* ERROR worker-+: timeout after *ms*', texts
+
+WORKLOADS = [('near_miss', near_miss), ('many_stars', many_stars),
+             ('long_literal', long_literal), ('log_lines', log_lines)]
+
+# Least number of seconds a measured run should take, repeating the
+# matches as many times as needed
+MIN_RUN_TIME = 0.05
+
+class TimedOut(Exception):
+    pass
+
+def _time_out(signum, frame):
+    raise TimedOut()
+
+def measure(regex, texts, engine, repeat, budget=None):
+    """
+    @param budget: The seconds after which every run is interrupted, where
+                   the platform has interval timers
+    @return: The best time of repeat runs of matching regex against all
+             the texts, or None if a run was interrupted. Runs are
+             repeated up to MIN_RUN_TIME, and their time divided.
+    """
+    pattern = basic_regex.compile(regex)
+    match = basic_regex.match
+    timer = timeit.Timer(lambda: [match(pattern, text, engine) for text in texts])
+    alarm = budget is not None and hasattr(signal, 'setitimer')
+    if alarm:
+        previous_handler = signal.signal(signal.SIGALRM, _time_out)
+    try:
+        best = None
+        number = 1
+        for i in xrange(repeat + 1):
+            if alarm:
+                signal.setitimer(signal.ITIMER_REAL, budget)
+            try:
+                seconds = timer.timeit(number=number) / number
+            finally:
+                if alarm:
+                    signal.setitimer(signal.ITIMER_REAL, 0)
+            if i == 0:
+                # The first run only finds how many times to repeat the matches
+                number = max(1, int(MIN_RUN_TIME / max(seconds, 1e-9)))
+            else:
+                best = seconds if best is None else min(best, seconds)
+        return best
+    except TimedOut:
+        return None
+    finally:
+        if alarm:
+            signal.signal(signal.SIGALRM, previous_handler)
+
+def run(sizes, repeat=3, budget=5.0, workloads=None, stdout=None):
+    """
+    Runs the workloads and prints their results as they come
+
+    @param budget: The seconds a run may take before it is stopped and
+                   larger sizes are skipped
+    @param workloads: The names of the workloads to run, all if None
+    @return: The list of results, each a dict with the workload, engine,
+             size, matches, seconds and ops_per_sec, where a run that timed
+             out has seconds and ops_per_sec set to None
+    """
+    stdout = stdout or sys.stdout
+    previous_tracer = basic_regex.set_tracer(None)
+    results = []
+    try:
+        for name, build in WORKLOADS:
+            if workloads and name not in workloads:
+                continue
+            stdout.write('%s\n' % name)
+            stdout.write('    %-14s %10s %14s %8s\n' % ('engine', 'size', 'ops/sec', 'scaling'))
+            for engine in ENGINES:
+                timed_out = False
+                per_op = None
+                for size in sizes:
+                    regex, texts = build(size, random.Random(size))
+                    result = {'workload': name, 'engine': engine, 'size': size,
+                              'matches': len(texts), 'seconds': None, 'ops_per_sec': None}
+                    results.append(result)
+                    if timed_out:
+                        stdout.write('    %-14s %10s %14s\n' % (engine, size, 'skipped'))
+                        continue
+                    seconds = measure(regex, texts, engine, repeat, budget)
+                    if seconds is None:
+                        timed_out = True
+                        stdout.write('    %-14s %10s %14s\n' % (engine, size, 'timed out'))
+                        continue
+                    result['seconds'] = seconds
+                    result['ops_per_sec'] = len(texts) / max(seconds, 1e-9)
+                    scaling = ''
+                    if per_op is not None:
+                        # Exponent of the growth of the time since the previous size
+                        scaling = '%8.2f' % (log(max(seconds, 1e-9) / per_op[1]) /
+                                             log(float(size) / per_op[0]))
+                    per_op = (size, max(seconds, 1e-9))
+                    stdout.write('    %-14s %10s %14.1f %8s\n' % (
+                            engine, size, result['ops_per_sec'], scaling))
+    finally:
+        basic_regex.set_tracer(previous_tracer)
+    return results
+
+def compare(results, baseline, threshold=1.25, stdout=None):
+    """
+    Prints the slowdown of every result against the same workload, engine
+    and size in baseline
+
+    @param threshold: The ratio of the baseline ops/sec to the current
+                      ops/sec above which a result is a regression
+    @return: The list of (workload, engine, size, ratio) regressions, where
+             a run that timed out but did not before has an infinite ratio
+    """
+    stdout = stdout or sys.stdout
+    before = dict(((r['workload'], r['engine'], r['size']), r) for r in baseline)
+    regressions = []
+    for result in results:
+        key = (result['workload'], result['engine'], result['size'])
+        old = before.get(key)
+        if old is None or old['ops_per_sec'] is None:
+            continue
+        if result['ops_per_sec'] is None:
+            ratio = float('inf')
+        else:
+            ratio = old['ops_per_sec'] / result['ops_per_sec']
+        flag = ' REGRESSION' if ratio > threshold else ''
+        stdout.write('%-14s %-14s %10s %8.2fx slower%s\n' % (key + (ratio, flag)))
+        if flag:
+            regressions.append(key + (ratio,))
+    return regressions
+
+def main(args):
+    parser = argparse.ArgumentParser(description='Benchmark the basic_regex engines')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES)
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='the number of runs to take the best of')
+    parser.add_argument('--budget', type=float, default=5.0,
+                        help='the seconds a run may take before larger sizes are skipped')
+    parser.add_argument('--workloads', nargs='+', choices=[name for name, build in WORKLOADS])
+    parser.add_argument('--output', help='the JSON file to write the results to')
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help='the JSON file of earlier results to compare with')
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help='the slowdown over the baseline that counts as a regression')
+    options = parser.parse_args(args)
+
+    results = run(options.sizes, options.repeat, options.budget, options.workloads)
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump({'python': platform.python_version(),
+                       'implementation': platform.python_implementation(),
+                       'results': results}, f, indent=2, sort_keys=True)
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)['results']
+        print
+        if compare(results, baseline, options.threshold):
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
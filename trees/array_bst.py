@@ -0,0 +1,588 @@
+#!/usr/bin/env python
+
+"""
+Array backed BST with the same interface as bst.Bst
+
+Instead of one Node object per value, the links of every node are kept in
+parallel typed arrays and the values in a list (or in a typed array when a
+typecode is given). A node is simply an index into these arrays, and the
+slots of deleted nodes are kept on a free list for reuse. This cuts the
+memory used per value several fold compared to Node objects.
+
+Methods that return nodes in bst.Bst return ArrayNode handles here, which
+look like a Node but are only a pointer to a slot. The tree has no
+visualization, so it always behaves like a headless Bst.
+
+Running this script executes all tests. Running it with --bench [n]
+compares the memory used per value against bst.Bst.
+
+"""
+
+__author__ = "Orko Garai (orko.garai@gmail.com)"
+
+from array import array
+from math import log
+import random
+import sys
+
+from bst import Bst, increasing_values, random_updates, unique_sorted
+
+NIL = -1
+
+class ArrayNode(object):
+    """
+    Handle to the node stored in slot index of an ArrayBst
+    """
+    __slots__ = ('tree', 'index')
+
+    def __init__(self, tree, index):
+        self.tree = tree
+        self.index = index
+
+    def __eq__(self, other):
+        return isinstance(other, ArrayNode) and self.tree is other.tree\
+                and self.index == other.index
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((id(self.tree), self.index))
+
+    @property
+    def val(self):
+        return self.tree.values[self.index]
+
+    @property
+    def left(self):
+        return self.tree._node(self.tree.lefts[self.index])
+
+    @property
+    def right(self):
+        return self.tree._node(self.tree.rights[self.index])
+
+    @property
+    def parent(self):
+        return self.tree._node(self.tree.parents[self.index])
+
+    @property
+    def height(self):
+        return self.tree.heights[self.index]
+
+    def is_leaf(self):
+        return self.tree.lefts[self.index] == NIL\
+                and self.tree.rights[self.index] == NIL
+
+    def successor(self):
+        return self.tree._node(self.tree._successor(self.index))
+
+    def predecessor(self):
+        return self.tree._node(self.tree._predecessor(self.index))
+
+class ArrayBst(object):
+    """
+    Binary search tree with the nodes stored in parallel arrays.
+
+    Passing balanced=True keeps the tree AVL balanced, like bst.Bst.
+    Passing a typecode from the array module, e.g. 'l' or 'd', stores the
+    values in a typed array as well, instead of a list of objects.
+    """
+    def __init__(self, balanced=False, typecode=None):
+        self.balanced = balanced
+        self.typecode = typecode
+        self.values = [] if typecode is None else array(typecode)
+        self.lefts = array('i')
+        self.rights = array('i')
+        self.parents = array('i')
+        # Heights stay below 64 for any number of nodes that fits in memory
+        self.heights = array('b')
+        self._root = NIL
+        self.free = NIL  # Head of the free list, linked through lefts
+        self.count = 0
+
+    def _node(self, index):
+        return None if index == NIL else ArrayNode(self, index)
+
+    @property
+    def root(self):
+        return self._node(self._root)
+
+    def __len__(self):
+        return self.count
+
+    def is_empty(self):
+        return self._root == NIL
+
+    def _new_slot(self, val, parent):
+        slot = self.free
+        if slot == NIL:
+            slot = len(self.lefts)
+            self.values.append(val)
+            self.lefts.append(NIL)
+            self.rights.append(NIL)
+            self.parents.append(parent)
+            self.heights.append(1)
+        else:
+            # Storing the value first leaves the free list as it was when
+            # the value does not fit in a typed array
+            self.values[slot] = val
+            self.free = self.lefts[slot]
+            self.lefts[slot] = NIL
+            self.rights[slot] = NIL
+            self.parents[slot] = parent
+            self.heights[slot] = 1
+        self.count += 1
+        return slot
+
+    def _free_slot(self, slot):
+        if self.typecode is None:
+            self.values[slot] = None  # Drop the reference to the value
+        self.lefts[slot] = self.free
+        self.rights[slot] = NIL
+        self.parents[slot] = NIL
+        self.free = slot
+        self.count -= 1
+
+    def insert(self, val):
+        if self._root == NIL:
+            self._root = self._new_slot(val, NIL)
+            return True
+        values, lefts, rights = self.values, self.lefts, self.rights
+        node = self._root
+        while True:
+            node_val = values[node]
+            if val == node_val:
+                return False
+            if val < node_val:
+                if lefts[node] == NIL:
+                    lefts[node] = self._new_slot(val, node)
+                    break
+                node = lefts[node]
+            else:
+                if rights[node] == NIL:
+                    rights[node] = self._new_slot(val, node)
+                    break
+                node = rights[node]
+        if self.balanced:
+            self._rebalance(node)
+        return True
+
+    def _find(self, val):
+        values, lefts, rights = self.values, self.lefts, self.rights
+        node = self._root
+        while node != NIL:
+            node_val = values[node]
+            if val == node_val:
+                return node
+            node = lefts[node] if val < node_val else rights[node]
+        return NIL
+
+    def find_node(self, val):
+        return self._node(self._find(val))
+
+    def __contains__(self, val):
+        return self._find(val) != NIL
+
+    def _min(self, node):
+        lefts = self.lefts
+        if node != NIL:
+            while lefts[node] != NIL:
+                node = lefts[node]
+        return node
+
+    def _max(self, node):
+        rights = self.rights
+        if node != NIL:
+            while rights[node] != NIL:
+                node = rights[node]
+        return node
+
+    def min_node(self, start=None):
+        return self._node(self._min(self._root if start is None else start.index))
+
+    def max_node(self, start=None):
+        return self._node(self._max(self._root if start is None else start.index))
+
+    def _successor(self, node):
+        if self.rights[node] != NIL:
+            return self._min(self.rights[node])
+        parents, rights = self.parents, self.rights
+        while parents[node] != NIL and node == rights[parents[node]]:
+            node = parents[node]
+        return parents[node]
+
+    def _predecessor(self, node):
+        if self.lefts[node] != NIL:
+            return self._max(self.lefts[node])
+        parents, lefts = self.parents, self.lefts
+        while parents[node] != NIL and node == lefts[parents[node]]:
+            node = parents[node]
+        return parents[node]
+
+    def get_values(self, start=None):
+        '''
+        Get values by iterative inorder tree traversal
+        '''
+        return list(self.iter_values(start))
+
+    def __iter__(self):
+        return self.iter_values()
+
+    def __reversed__(self):
+        return self.iter_values(reverse=True)
+
+    def iter_values(self, start=None, reverse=False):
+        '''
+        Lazily yields the values of the subtree rooted at the node holding
+        start (the whole tree by default) in order, or in reverse order.
+        '''
+        start = self._root if start is None else self._find(start)
+        if start == NIL:
+            return
+        if reverse:
+            node, last, step = self._max(start), self._min(start), self._predecessor
+        else:
+            node, last, step = self._min(start), self._max(start), self._successor
+        values = self.values
+        while True:
+            yield values[node]
+            if node == last:
+                return
+            node = step(node)
+
+    def _ceiling(self, val):
+        values, lefts, rights = self.values, self.lefts, self.rights
+        node = self._root
+        found = NIL
+        while node != NIL:
+            node_val = values[node]
+            if val == node_val:
+                return node
+            if val < node_val:
+                found = node
+                node = lefts[node]
+            else:
+                node = rights[node]
+        return found
+
+    def _floor(self, val):
+        values, lefts, rights = self.values, self.lefts, self.rights
+        node = self._root
+        found = NIL
+        while node != NIL:
+            node_val = values[node]
+            if val == node_val:
+                return node
+            if val > node_val:
+                found = node
+                node = rights[node]
+            else:
+                node = lefts[node]
+        return found
+
+    def ceiling_node(self, val=None):
+        '''
+        Returns the node with the smallest value >= val
+        '''
+        return self._node(self._min(self._root) if val is None else self._ceiling(val))
+
+    def floor_node(self, val=None):
+        '''
+        Returns the node with the largest value <= val
+        '''
+        return self._node(self._max(self._root) if val is None else self._floor(val))
+
+    def iter_range(self, lo=None, hi=None, reverse=False):
+        '''
+        Lazily yields the values v with lo <= v <= hi in order, or in reverse
+        order. A bound of None leaves that side open.
+        '''
+        values = self.values
+        if reverse:
+            node = self._max(self._root) if hi is None else self._floor(hi)
+            while node != NIL and (lo is None or values[node] >= lo):
+                yield values[node]
+                node = self._predecessor(node)
+        else:
+            node = self._min(self._root) if lo is None else self._ceiling(lo)
+            while node != NIL and (hi is None or values[node] <= hi):
+                yield values[node]
+                node = self._successor(node)
+
+    def delete(self, val):
+        node = self._find(val)
+        if node == NIL:
+            return False
+        lefts, rights = self.lefts, self.rights
+        if lefts[node] != NIL and rights[node] != NIL:
+            # Has both left and right children, so take over the value of the
+            # in-order successor and remove the successor node instead
+            rmin = self._min(rights[node])
+            self.values[node] = self.values[rmin]
+            node = rmin
+        parent = self.parents[node]
+        child = lefts[node] if lefts[node] != NIL else rights[node]
+        self._replace_child(parent, node, child)
+        self._free_slot(node)
+        if self.balanced and parent != NIL:
+            self._rebalance(parent)
+        return True
+
+    def _replace_child(self, parent, child, new_child):
+        if parent == NIL:
+            self._root = new_child
+        elif child == self.lefts[parent]:
+            self.lefts[parent] = new_child
+        else:
+            self.rights[parent] = new_child
+        if new_child != NIL:
+            self.parents[new_child] = parent
+
+    def _height(self, node):
+        return 0 if node == NIL else self.heights[node]
+
+    def _update_height(self, node):
+        self.heights[node] = 1 + max(self._height(self.lefts[node]),
+                                     self._height(self.rights[node]))
+
+    def _rebalance(self, node):
+        '''
+        Restore the AVL invariant on the path from node up to the root,
+        stopping as soon as a subtree height is left unchanged
+        '''
+        lefts, rights, height = self.lefts, self.rights, self._height
+        while node != NIL:
+            parent = self.parents[node]
+            old_height = self.heights[node]
+            balance = height(lefts[node]) - height(rights[node])
+            if balance > 1:
+                left = lefts[node]
+                if height(lefts[left]) < height(rights[left]):
+                    self._rotate_left(left)
+                node = self._rotate_right(node)
+            elif balance < -1:
+                right = rights[node]
+                if height(rights[right]) < height(lefts[right]):
+                    self._rotate_right(right)
+                node = self._rotate_left(node)
+            else:
+                self._update_height(node)
+            if self.heights[node] == old_height:
+                return
+            node = parent
+
+    def _rotate_left(self, node):
+        lefts, rights, parents = self.lefts, self.rights, self.parents
+        pivot = rights[node]
+        inner = lefts[pivot]
+        rights[node] = inner
+        if inner != NIL:
+            parents[inner] = node
+        self._replace_child(parents[node], node, pivot)
+        lefts[pivot] = node
+        parents[node] = pivot
+        self._update_height(node)
+        self._update_height(pivot)
+        return pivot
+
+    def _rotate_right(self, node):
+        lefts, rights, parents = self.lefts, self.rights, self.parents
+        pivot = lefts[node]
+        inner = rights[pivot]
+        lefts[node] = inner
+        if inner != NIL:
+            parents[inner] = node
+        self._replace_child(parents[node], node, pivot)
+        rights[pivot] = node
+        parents[node] = pivot
+        self._update_height(node)
+        self._update_height(pivot)
+        return pivot
+
+    @classmethod
+    def from_sorted(cls, values, **kwargs):
+        '''
+        Builds a perfectly balanced tree from strictly increasing values in
+        O(n), filling the slots in order. Takes the same keyword arguments
+        as the constructor.
+        '''
+        values = increasing_values(values)
+        tree = cls(**kwargs)
+        n = len(values)
+        # Slot i holds values[i], so only the links need to be computed
+        tree.values.extend(values)
+        tree.lefts = array('i', [NIL]) * n
+        tree.rights = array('i', [NIL]) * n
+        tree.parents = array('i', [NIL]) * n
+        tree.heights = array('b', [1]) * n
+        tree.count = n
+        if n:
+            tree._root = tree._build(0, n, NIL)
+        return tree
+
+    @classmethod
+    def from_iterable(cls, values, **kwargs):
+        '''
+        Builds a perfectly balanced tree from values in any order, dropping
+        duplicates
+        '''
+        return cls.from_sorted(unique_sorted(values), **kwargs)
+
+    def _build(self, lo, hi, parent):
+        mid = (lo + hi) // 2
+        self.parents[mid] = parent
+        self.heights[mid] = (hi - lo).bit_length()
+        if lo < mid:
+            self.lefts[mid] = self._build(lo, mid, mid)
+        if mid + 1 < hi:
+            self.rights[mid] = self._build(mid + 1, hi, mid)
+        return mid
+
+    def memory_size(self):
+        '''
+        Returns the bytes used by the arrays of the tree, including the
+        value objects when they are not stored in a typed array
+        '''
+        size = sum(sys.getsizeof(a) for a in
+                   [self.values, self.lefts, self.rights, self.parents, self.heights])
+        if self.typecode is None:
+            size += sum(sys.getsizeof(val) for val in self.values if val is not None)
+        return size
+
+def bst_memory_size(b):
+    '''
+    Returns the bytes used by the Node objects of a bst.Bst, including
+    their values
+    '''
+    size = sys.getsizeof(b)
+    node = b.min_node()
+    while node is not None:
+        size += sys.getsizeof(node) + sys.getsizeof(node.val)
+        node = node.successor()
+    return size
+
+def memory_benchmark(n=100000):
+    '''
+    Prints the bytes used per value by bst.Bst and ArrayBst trees of n
+    values, built by random inserts
+    '''
+    values = random.sample(xrange(10 * n), n)
+    trees = [('Bst (Node objects)', Bst(balanced=True, headless=True)),
+             ('ArrayBst (list of values)', ArrayBst(balanced=True)),
+             ("ArrayBst (typecode 'l')", ArrayBst(balanced=True, typecode='l'))]
+    print 'Bytes per value for %s values:' % n
+    for name, tree in trees:
+        for val in values:
+            tree.insert(val)
+        if isinstance(tree, Bst):
+            size = bst_memory_size(tree)
+        else:
+            size = tree.memory_size()
+        print '    %-28s %6.1f' % (name, float(size) / n)
+
+def check_tree(b):
+    '''
+    Checks ordering, parent links and the free list of the tree, along with
+    the AVL invariant for balanced trees. Returns the height of the tree.
+    '''
+    seen = [0]
+    def check(node, parent, lo, hi):
+        if node == NIL:
+            return 0
+        seen[0] += 1
+        val = b.values[node]
+        assert b.parents[node] == parent
+        assert lo is None or val > lo
+        assert hi is None or val < hi
+        left = check(b.lefts[node], node, lo, val)
+        right = check(b.rights[node], node, val, hi)
+        if b.balanced:
+            assert abs(left - right) <= 1
+            assert b.heights[node] == 1 + max(left, right)
+        return 1 + max(left, right)
+    height = check(b._root, NIL, None, None)
+    assert seen[0] == len(b)
+    free = 0
+    slot = b.free
+    while slot != NIL:
+        free += 1
+        slot = b.lefts[slot]
+    assert free + len(b) == len(b.lefts)
+    return height
+
+def test_array_bst():
+    '''
+    Method that tests ArrayBst against a sorted list
+    '''
+    rand = random.Random(7)
+    for balanced in [False, True]:
+        for typecode in [None, 'l']:
+            b = ArrayBst(balanced=balanced, typecode=typecode)
+            assert b.is_empty()
+            assert b.root is None
+            assert b.min_node() is None
+            assert b.max_node() is None
+            assert b.find_node(1) is None
+            assert b.get_values() == []
+            assert b.delete(1) is False
+            values = random_updates(b, rand, 2000, 300, lambda b, values: check_tree(b))
+            assert b.get_values() == values
+            assert list(reversed(b)) == values[::-1]
+            assert list(b.iter_range(100, 200)) == [v for v in values if 100 <= v <= 200]
+            assert list(b.iter_range(100, 200, reverse=True)) ==\
+                    [v for v in values if 100 <= v <= 200][::-1]
+            assert b.min_node().val == values[0]
+            assert b.max_node().val == values[-1]
+            node = b.find_node(values[len(values) // 2])
+            assert node.val == values[len(values) // 2]
+            assert b.get_values(node.val) == \
+                    [v for v in values if b.min_node(node).val <= v <= b.max_node(node).val]
+            assert node.successor().val == values[len(values) // 2 + 1]
+            assert node.predecessor().val == values[len(values) // 2 - 1]
+            assert b.ceiling_node(-1).val == values[0]
+            assert b.floor_node(1000).val == values[-1]
+            assert (values[0] in b) and (1000 not in b)
+            for val in values:
+                assert b.delete(val) is True
+            check_tree(b)
+            assert b.is_empty()
+            # Freed slots get reused
+            slots = len(b.lefts)
+            for val in xrange(slots):
+                b.insert(val)
+            assert len(b.lefts) == slots
+            if typecode is not None:
+                # A value that does not fit takes no slot, new or freed
+                for freed in [False, True]:
+                    if freed:
+                        b.delete(0)
+                    try:
+                        b.insert(2.5)
+                        assert False, 'Floats should not fit in an array of longs'
+                    except TypeError:
+                        pass
+                    check_tree(b)
+
+    # Sorted inserts stay within the AVL height bound
+    b = ArrayBst(balanced=True, typecode='l')
+    for val in xrange(1000):
+        b.insert(val)
+    assert check_tree(b) <= 1.44 * log(1002, 2)
+
+    for n in [0, 1, 2, 10, 100]:
+        b = ArrayBst.from_sorted(xrange(n), balanced=True)
+        assert check_tree(b) == (n.bit_length())
+        assert b.get_values() == range(n)
+    b = ArrayBst.from_iterable([3, 1, 3, 2], typecode='d')
+    assert b.get_values() == [1.0, 2.0, 3.0]
+    try:
+        ArrayBst.from_sorted([2, 1])
+        assert False, 'Unsorted values should be rejected'
+    except ValueError:
+        pass
+
+if __name__ == '__main__':
+    test_array_bst()
+    if '--bench' in sys.argv:
+        args = sys.argv[sys.argv.index('--bench') + 1:]
+        memory_benchmark(int(args[0]) if args else 100000)
@@ -8,14 +8,47 @@ For more info on DOT visit http://www.graphviz.org/
 There are sleeps introduced in the code so that you can watch the png
 image (in your file manager's preview window) while the script is executin.
 
+The visualization is done by observers attached to the tree. A tree created
+with headless=True has none, so it neither sleeps, prints nor renders.
+
+A Bst changes its nodes in place, so threads reading it while another one
+writes need a lock. persistent_bst.PersistentBst keeps every version of
+the tree instead, for readers that need no lock.
+
+bst_bench.py measures the time, height and memory of headless trees under
+various workloads.
+
+A tree of numbers can be saved to a snapshot file with Bst.save, and read
+back with Bst.load, or mapped to memory as a read-only MmapBst with
+Bst.open_mmap. The snapshot holds a header, the values in order as an
+array of fixed width, and the shape of the tree as two bits per node in
+preorder, telling if the node has a left and a right child.
+
 """
 
 __author__ = "Orko Garai (orko.garai@gmail.com)"
 
-from collections import OrderedDict
+from collections import Counter, OrderedDict
+from math import log
+from operator import attrgetter
 from subprocess import call
-from time import sleep
+from threading import Condition, Lock, Thread
+from array import array
+from time import sleep, time
+import gc
+import mmap
+import os
+import random
+import shutil
+import struct
+import sys
+import tempfile
 
+SNAPSHOT_MAGIC = 'BSTS'
+SNAPSHOT_VERSION = 1
+# Magic, version, balanced, array typecode, item size, byte order, count.
+# The padding keeps the values that follow 8 byte aligned.
+SNAPSHOT_HEADER = struct.Struct('<4sHBcBc6xQ')
 
 DOT_HEADER = '''\
 graph test_tree {
@@ -27,27 +60,424 @@ graph test_tree {
 '''
 
 class Node(object):
+    # Without a __dict__ per node, a tree takes about a third of the memory
+    __slots__ = ('val', 'left', 'right', 'parent', 'height', 'size')
+
     def __init__(self, val):
         self.val = val
         self.left = None
         self.right = None
         self.parent = None
+        self.height = 1  # Only maintained by balanced trees
+        self.size = 1  # Number of nodes in the subtree rooted here
 
     def is_leaf(self):
         return self.left is None and self.right is None
 
-class Dot(object):
+    def successor(self):
+        '''
+        Returns the next node in order, found through the parent pointers
+        '''
+        node = self
+        if node.right is not None:
+            node = node.right
+            while node.left is not None:
+                node = node.left
+            return node
+        while node.parent is not None and node is node.parent.right:
+            node = node.parent
+        return node.parent
+
+    def predecessor(self):
+        '''
+        Returns the previous node in order, found through the parent pointers
+        '''
+        node = self
+        if node.left is not None:
+            node = node.left
+            while node.right is not None:
+                node = node.right
+            return node
+        while node.parent is not None and node is node.parent.left:
+            node = node.parent
+        return node.parent
+
+def _height(node):
+    return 0 if node is None else node.height
+
+def _size(node):
+    return 0 if node is None else node.size
+
+def _read_snapshot_header(data):
+    '''
+    Checks the header of a snapshot and returns whether the tree was
+    balanced, the typecode of its values, whether their bytes must be
+    swapped, and their count
+    '''
+    if len(data) < SNAPSHOT_HEADER.size:
+        raise ValueError('Snapshot is truncated')
+    magic, version, balanced, typecode, itemsize, byteorder, count = \
+            SNAPSHOT_HEADER.unpack_from(data)
+    if magic != SNAPSHOT_MAGIC:
+        raise ValueError('Not a snapshot of a tree')
+    if version != SNAPSHOT_VERSION:
+        raise ValueError('Unsupported snapshot version %s' % version)
+    if array(typecode).itemsize != itemsize:
+        raise ValueError("Values of typecode '%s' are not %s bytes wide here"
+                         % (typecode, itemsize))
+    swap = byteorder != ('<' if sys.byteorder == 'little' else '>')
+    return balanced, typecode, swap, count
+
+def _build_shape(values, shape):
+    '''
+    Builds the nodes of a tree of the given shape, two bits per node in
+    preorder, holding values in order, and returns its root
+    '''
+    count = len(values)
+    if not count:
+        return None
+    nodes = [Node(None) for i in xrange(count)]
+    # Parents still waiting for a child, the nearest last
+    pending = []
+    for i, node in enumerate(nodes):
+        if i:
+            if not pending:
+                raise ValueError('Snapshot shape has too many nodes')
+            parent, is_left = pending.pop()
+            node.parent = parent
+            if is_left:
+                parent.left = node
+            else:
+                parent.right = node
+        bits = (shape[i >> 2] >> ((i & 3) << 1)) & 3
+        if bits & 2:
+            pending.append((node, False))
+        if bits & 1:
+            pending.append((node, True))
+    if pending:
+        raise ValueError('Snapshot shape has too few nodes')
+    # Children come after their parent in preorder
+    for node in reversed(nodes):
+        node.height = 1 + max(_height(node.left), _height(node.right))
+        node.size = 1 + _size(node.left) + _size(node.right)
+    node = nodes[0]
+    while node.left is not None:
+        node = node.left
+    for val in values:
+        node.val = val
+        node = node.successor()
+    return nodes[0]
+
+# The functions below work on detached subtrees, given by their root node.
+# They reuse the nodes they are given and return the root of the result,
+# whose parent pointer is left for the caller to set.
+
+def _link(node, left, right):
+    node.left = left
+    node.right = right
+    if left is not None:
+        left.parent = node
+    if right is not None:
+        right.parent = node
+    node.height = 1 + max(_height(left), _height(right))
+    node.size = 1 + _size(left) + _size(right)
+    return node
+
+def _rotate_left_subtree(node):
+    pivot = node.right
+    _link(node, node.left, pivot.left)
+    return _link(pivot, node, pivot.right)
+
+def _rotate_right_subtree(node):
+    pivot = node.left
+    _link(node, pivot.right, node.right)
+    return _link(pivot, pivot.left, node)
+
+def _join(left, mid, right, balanced):
+    '''
+    Joins the subtrees left and right, whose values all lie below and above
+    the value of mid, using mid as the node in between. Balanced subtrees
+    are joined in O(difference of their heights) into a balanced subtree.
+    '''
+    if balanced:
+        if _height(left) > _height(right) + 1:
+            return _join_right(left, mid, right)
+        if _height(right) > _height(left) + 1:
+            return _join_left(left, mid, right)
+    return _link(mid, left, right)
+
+def _join_right(left, mid, right):
+    # Descend the right spine of left to a subtree about as high as right
+    if _height(left.right) <= _height(right) + 1:
+        sub = _link(mid, left.right, right)
+        if sub.height <= _height(left.left) + 1:
+            return _link(left, left.left, sub)
+        return _rotate_left_subtree(_link(left, left.left, _rotate_right_subtree(sub)))
+    sub = _join_right(left.right, mid, right)
+    if sub.height <= _height(left.left) + 1:
+        return _link(left, left.left, sub)
+    return _rotate_left_subtree(_link(left, left.left, sub))
+
+def _join_left(left, mid, right):
+    # Descend the left spine of right to a subtree about as high as left
+    if _height(right.left) <= _height(left) + 1:
+        sub = _link(mid, left, right.left)
+        if sub.height <= _height(right.right) + 1:
+            return _link(right, sub, right.right)
+        return _rotate_right_subtree(_link(right, _rotate_left_subtree(sub), right.right))
+    sub = _join_left(left, mid, right.left)
+    if sub.height <= _height(right.right) + 1:
+        return _link(right, sub, right.right)
+    return _rotate_right_subtree(_link(right, sub, right.right))
+
+def _join2(left, right, balanced):
+    '''
+    Joins the subtrees left and right, whose values all lie below and above
+    each other, using the largest node of left as the node in between
+    '''
+    if left is None:
+        return right
+    last = left
+    while last.right is not None:
+        last = last.right
+    left, last, _ = _split(left, last.val, balanced)
+    return _join(left, last, right, balanced)
+
+def _split(node, val, balanced):
+    '''
+    Splits the subtree under node into the subtrees holding the values < val
+    and > val. Returns them along with the node holding val, if any, which
+    is left detached. Takes O(height).
+    '''
+    path = []
+    found = None
+    while node is not None:
+        if val == node.val:
+            found = node
+            break
+        path.append(node)
+        node = node.left if val < node.val else node.right
+    left = right = None
+    if found is not None:
+        left, right = found.left, found.right
+        _link(found, None, None)
+    # Join the pieces hanging off the search path from the bottom up
+    for node in reversed(path):
+        if val < node.val:
+            right = _join(right, node, node.right, balanced)
+        else:
+            left = _join(node.left, node, left, balanced)
+    for root in [left, found, right]:
+        if root is not None:
+            root.parent = None
+    return left, found, right
+
+def _union(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    a_left, a_right = a.left, a.right
+    b_left, _, b_right = _split(b, a.val, True)
+    return _join(_union(a_left, b_left), a, _union(a_right, b_right), True)
+
+def _intersection(a, b):
+    if a is None or b is None:
+        return None
+    a_left, a_right = a.left, a.right
+    b_left, found, b_right = _split(b, a.val, True)
+    left = _intersection(a_left, b_left)
+    right = _intersection(a_right, b_right)
+    if found is not None:
+        return _join(left, a, right, True)
+    return _join2(left, right, True)
+
+def _difference(a, b):
+    if a is None or b is None:
+        return a
+    b_left, b_right = b.left, b.right
+    a_left, _, a_right = _split(a, b.val, True)
+    return _join2(_difference(a_left, b_left), _difference(a_right, b_right), True)
+
+def _merge(a, b, keep_a, keep_both, keep_b, key=None):
+    '''
+    Merges the increasing iterables a and b, yielding the values found only
+    in a, in both or only in b as requested. With a key, the items are
+    ordered by key(item), and an item found in both is yielded from a.
+    '''
+    a = iter(a)
+    b = iter(b)
+    end = object()
+    x = next(a, end)
+    y = next(b, end)
+    while x is not end and y is not end:
+        kx, ky = (key(x), key(y)) if key else (x, y)
+        if kx < ky:
+            if keep_a:
+                yield x
+            x = next(a, end)
+        elif ky < kx:
+            if keep_b:
+                yield y
+            y = next(b, end)
+        else:
+            if keep_both:
+                yield x
+            x = next(a, end)
+            y = next(b, end)
+    while keep_a and x is not end:
+        yield x
+        x = next(a, end)
+    while keep_b and y is not end:
+        yield y
+        y = next(b, end)
+
+def increasing_values(values):
+    '''
+    Returns the list of values, raising ValueError if they are not strictly
+    increasing. Shared by the from_sorted methods of the trees.
+    '''
+    values = list(values)
+    for i in xrange(1, len(values)):
+        if not values[i - 1] < values[i]:
+            raise ValueError('Values are not strictly increasing at position %s' % i)
+    return values
+
+def unique_sorted(values):
+    '''
+    Returns the distinct values in increasing order, in O(n log n)
+    '''
+    values = sorted(values)
+    unique = values[:1]
+    for val in values:
+        if val != unique[-1]:
+            unique.append(val)
+    return unique
+
+def _iter_nodes(root):
+    '''
+    Yields the nodes of the subtree under root in order
+    '''
+    stack = []
+    node = root
+    while stack or node is not None:
+        while node is not None:
+            stack.append(node)
+            node = node.left
+        node = stack.pop()
+        yield node
+        node = node.right
+
+def _relink(nodes, lo, hi, parent):
+    '''
+    Links nodes[lo:hi] into a perfectly balanced subtree and returns its
+    root, like Bst._build does with new nodes
+    '''
+    mid = (lo + hi) // 2
+    node = nodes[mid]
+    node.parent = parent
+    node.height = (hi - lo).bit_length()
+    node.size = hi - lo
+    node.left = _relink(nodes, lo, mid, node) if lo < mid else None
+    node.right = _relink(nodes, mid + 1, hi, node) if mid + 1 < hi else None
+    return node
+
+class TreeObserver(object):
+    """
+    Base class for objects that follow the changes made to a Bst.
+    """
+    def reset(self):
+        '''
+        Called when the tree becomes empty
+        '''
+        pass
+
+    def update_node(self, node):
+        '''
+        Called when the value or the children of node have changed
+        '''
+        pass
+
+    def remove_node(self, node):
+        '''
+        Called when node has been taken out of the tree
+        '''
+        pass
+
+    def announce(self, msg):
+        '''
+        Called before every operation on the tree
+        '''
+        pass
+
+class Narrator(TreeObserver):
+    """
+    Prints every operation and pauses, so that the changes can be watched
+    """
+    def __init__(self, delay=5):
+        self.delay = delay
+
+    def announce(self, msg):
+        print msg
+        sleep(self.delay)
+
+class Dot(TreeObserver):
+    """
+    Writes the tree to a DOT file and renders it to png.
+
+    By default every change is rendered right away. With a render_interval
+    (in seconds) the rendering is done by a background thread instead, at
+    most once per interval. Changes made while a render is running are
+    coalesced into the next one, so the tree never waits for the renderer.
+    Call flush() to wait until the latest state has been rendered, and
+    close() to stop the thread, after which changes are ignored.
+    """
     header = DOT_HEADER
     footer = '}\n'
 
-    def __init__(self, dot_file_path):
-        self.nodes = OrderedDict()
+    def __init__(self, dot_file_path, render_interval=None):
         self.file_path = dot_file_path
         self.lonely_root = False
-        self.blank = 0
-        self.write()
+        self.render_interval = render_interval
+        self.worker = None
+        if render_interval is not None:
+            self.lock = Lock()
+            self.changed = Condition(self.lock)
+            self.version = 0
+            self.rendered = 0
+            self.flushing = 0
+            self.closed = False
+            self.error = None
+            self.worker = Thread(target=self._render_loop, name='dot-renderer')
+            self.worker.daemon = True
+            self.worker.start()
+        self.reset()
+
+    def reset(self):
+        if self.worker is None:
+            self.nodes = OrderedDict()
+            self.blank = 0
+            self.write()
+        else:
+            with self.lock:
+                if self.closed:
+                    return
+                self.nodes = OrderedDict()
+                self.blank = 0
+                self._changed()
 
     def update_node(self, node):
+        if self.worker is not None:
+            with self.lock:
+                if self.closed:
+                    return
+                self._update_node(node)
+                self._changed()
+        else:
+            self._update_node(node)
+            self.write()
+
+    def _update_node(self, node):
         dot_str = ''
         for child in [node.left, node.right]:
             if child is None:
@@ -57,11 +487,17 @@ class Dot(object):
         if node.parent is None:
             dot_str += '    %s[root=true];\n' % node.val
         self.nodes[node] = dot_str
-        self.write()
 
     def remove_node(self, node):
-        del self.nodes[node]
-        self.write()
+        if self.worker is not None:
+            with self.lock:
+                if self.closed:
+                    return
+                del self.nodes[node]
+                self._changed()
+        else:
+            del self.nodes[node]
+            self.write()
 
     def _add_child(self, parent_val, child_val):
         return '    %s -- %s;\n' % (parent_val, child_val)
@@ -77,33 +513,550 @@ class Dot(object):
         return 'blank%s' % self.blank
 
     def write(self):
+        self._render(list(self.nodes.values()))
+
+    def _render(self, dot_strs):
         with open(self.file_path, 'w') as f:
             f.write(Dot.header)
-            for dot_str in self.nodes.values():
+            for dot_str in dot_strs:
                 f.write(dot_str)
             f.write(Dot.footer)
-        call(['dot', '-Tpng', 'bst.dot', '-O'])
+        call(['dot', '-Tpng', self.file_path, '-O'])
+
+    def _changed(self):
+        # Must be called with the lock held
+        self.version += 1
+        self.changed.notify_all()
+
+    def _render_loop(self):
+        while True:
+            with self.lock:
+                while self.rendered == self.version and not self.closed:
+                    self.changed.wait()
+                if self.rendered == self.version:
+                    return
+                version = self.version
+                dot_strs = list(self.nodes.values())
+            try:
+                self._render(dot_strs)
+            except Exception as e:
+                with self.lock:
+                    self.error = e
+            with self.lock:
+                self.rendered = version
+                self.changed.notify_all()
+                # Keep to the render rate, unless someone is waiting
+                deadline = time() + self.render_interval
+                while not self.flushing and not self.closed:
+                    remaining = deadline - time()
+                    if remaining <= 0:
+                        break
+                    self.changed.wait(remaining)
+
+    def flush(self):
+        '''
+        Blocks until every change made so far has been rendered. Raises the
+        last rendering error, if any.
+        '''
+        if self.worker is None:
+            return
+        with self.lock:
+            target = self.version
+            self.flushing += 1
+            self.changed.notify_all()
+            try:
+                while self.rendered < target and self.worker.is_alive():
+                    self.changed.wait()
+            finally:
+                self.flushing -= 1
+            error, self.error = self.error, None
+        if error is not None:
+            raise error
+
+    def close(self):
+        '''
+        Renders the pending changes and stops the background thread. Raises
+        the last rendering error, if any.
+        '''
+        if self.worker is None:
+            return
+        with self.lock:
+            self.closed = True
+            self.changed.notify_all()
+        self.worker.join()
+        error, self.error = self.error, None
+        if error is not None:
+            raise error
+
+class BstStats(object):
+    """
+    Counts of the operations on a Bst, kept once it is instrumented with
+    Bst.instrument.
+
+    For every find, insert and delete, by kind, it counts the operations
+    and the comparisons of values made, along with a histogram of the depth
+    the search reached. Rotations are counted too. The batch operations,
+    bulk loading and set algebra are not instrumented.
+
+    The callback, if any, is called as callback(kind, val, comparisons,
+    depth) after every operation.
+    """
+    def __init__(self, tree, callback=None):
+        self.tree = tree
+        self.callback = callback
+        self.reset()
+
+    def reset(self):
+        self.operations = Counter()
+        self.comparisons = Counter()
+        self.max_comparisons = Counter()
+        self.depths = Counter()
+        self.rotations = Counter()
+
+    def record(self, kind, val, comparisons, depth):
+        self.operations[kind] += 1
+        self.comparisons[kind] += comparisons
+        if comparisons > self.max_comparisons[kind]:
+            self.max_comparisons[kind] = comparisons
+        self.depths[depth] += 1
+        if self.callback is not None:
+            self.callback(kind, val, comparisons, depth)
+
+    def snapshot(self):
+        '''
+        Returns the counts as a dict of plain values, along with the current
+        height and number of nodes of the tree
+        '''
+        root = self.tree.root
+        if self.tree.balanced:
+            height = _height(root)
+        else:
+            height = 0
+            level = [root] if root is not None else []
+            while level:
+                height += 1
+                level = [child for node in level for child in (node.left, node.right)
+                         if child is not None]
+        return {
+            'nodes': _size(root),
+            'height': height,
+            'operations': dict(self.operations),
+            'comparisons': dict(self.comparisons),
+            'mean_comparisons': dict((kind, float(self.comparisons[kind]) / count)
+                                     for kind, count in self.operations.iteritems()),
+            'max_comparisons': dict(self.max_comparisons),
+            'depths': dict(self.depths),
+            'max_depth': max(self.depths) if self.depths else 0,
+            'rotations': dict(self.rotations),
+        }
 
 class Bst(object):
+    """
+    Binary search tree.
+
+    Passing balanced=True keeps the tree AVL balanced, so that the height
+    stays within 1.44 * log2(n) even when the values arrive in sorted order.
+    """
     dot_file_path = 'bst.dot'
-    def __init__(self):
-        print 'Initializing new BST'
-        sleep(5)
+    def __init__(self, balanced=False, headless=False):
         self.root = None
-        self._init_graph()
+        self.balanced = balanced
+        self.observers = []
+        self.stats = None
+        if not headless:
+            self.attach(Narrator())
+            self._announce('Initializing new %sBST' % ('balanced ' if balanced else ''))
+            self.attach(Dot(Bst.dot_file_path))
+
+    def attach(self, observer):
+        '''
+        Attaches an observer, e.g. a Dot to visualize the tree, and tells it
+        about the nodes already in the tree. Returns the observer.
+        '''
+        self.observers.append(observer)
+        self._replay(observer)
+        return observer
+
+    def _replay(self, observer):
+        node = self.min_node()
+        while node is not None:
+            observer.update_node(node)
+            node = node.successor()
+
+    def detach(self, observer):
+        self.observers.remove(observer)
+
+    # Methods replaced on an instrumented tree by their counterparts ending
+    # in _instrumented
+    _instrumented = ['find_node', 'insert', 'delete', '_rotate_left', '_rotate_right']
+
+    def instrument(self, callback=None):
+        '''
+        Starts keeping statistics of the operations on this tree, and
+        returns the BstStats they go into. The instrumented methods are set
+        on this instance only, so the loops of other trees are left as they
+        are and cost nothing extra.
+        '''
+        if self.stats is None:
+            for name in Bst._instrumented:
+                setattr(self, name, getattr(self, name + '_instrumented'))
+        self.stats = BstStats(self, callback)
+        return self.stats
+
+    def uninstrument(self):
+        '''
+        Stops keeping statistics and returns the BstStats kept so far
+        '''
+        stats = self.stats
+        if stats is not None:
+            for name in Bst._instrumented:
+                delattr(self, name)
+            self.stats = None
+        return stats
+
+    def _descend(self, val):
+        '''
+        Searches for val like find_node, counting the comparisons made
+        Returns the node holding val or None, the last node visited, the
+        number of comparisons and the depth reached
+        '''
+        node = self.root
+        parent = None
+        comparisons = 0
+        depth = 0
+        while node is not None:
+            depth += 1
+            comparisons += 1
+            if val == node.val:
+                return node, node, comparisons, depth
+            comparisons += 1
+            parent = node
+            node = node.left if val < node.val else node.right
+        return None, parent, comparisons, depth
+
+    def find_node_instrumented(self, val):
+        node, last, comparisons, depth = self._descend(val)
+        self.stats.record('find', val, comparisons, depth)
+        return node
+
+    def insert_instrumented(self, val):
+        if self.observers:
+            self._announce('Attempting to insert %s' % val)
+        node, parent, comparisons, depth = self._descend(val)
+        if node is None:
+            if parent is None:
+                self.root = Node(val)
+                if self.observers:
+                    self._notify_update(self.root)
+            else:
+                self._attach_leaf(parent, val)
+        self.stats.record('insert', val, comparisons, depth)
+        return node is None
+
+    def delete_instrumented(self, val):
+        if self.observers:
+            self._announce('Attempting to delete %s' % val)
+        node, last, comparisons, depth = self._descend(val)
+        if node is not None:
+            self._delete_node(node)
+        self.stats.record('delete', val, comparisons, depth)
+        return node is not None
+
+    def _rotate_left_instrumented(self, node):
+        self.stats.rotations['left'] += 1
+        return Bst._rotate_left(self, node)
+
+    def _rotate_right_instrumented(self, node):
+        self.stats.rotations['right'] += 1
+        return Bst._rotate_right(self, node)
+
+    def _announce(self, msg):
+        for observer in self.observers:
+            observer.announce(msg)
+
+    def _notify_update(self, *nodes):
+        for observer in self.observers:
+            for node in nodes:
+                observer.update_node(node)
+
+    def _notify_remove(self, node):
+        for observer in self.observers:
+            observer.remove_node(node)
+
+    def _notify_reset(self):
+        for observer in self.observers:
+            observer.reset()
+
+    def _notify_rebuilt(self):
+        for observer in self.observers:
+            observer.reset()
+            self._replay(observer)
+
+    def _take_root(self):
+        '''
+        Empties the tree and returns its old root, which is then detached
+        '''
+        root = self.root
+        if root is not None:
+            self.root = None
+            if self.observers:
+                self._notify_reset()
+        return root
+
+    def _adopt(self, root):
+        if root is not None:
+            root.parent = None
+        self.root = root
+        if self.observers:
+            self._notify_rebuilt()
+
+    def split(self, val, **kwargs):
+        '''
+        Moves the values < val and >= val into two new trees, which are
+        returned, leaving this tree empty. Takes O(height). Takes the
+        keyword arguments of the constructor, apart from balanced, which
+        is inherited.
+        '''
+        left, found, right = _split(self._take_root(), val, self.balanced)
+        if found is not None:
+            right = _join(None, found, right, self.balanced)
+        left_tree = self.__class__(balanced=self.balanced, **kwargs)
+        left_tree._adopt(left)
+        right_tree = self.__class__(balanced=self.balanced, **kwargs)
+        right_tree._adopt(right)
+        return left_tree, right_tree
+
+    @classmethod
+    def join(cls, left, right, **kwargs):
+        '''
+        Moves the values of the trees left and right, where every value of
+        left is below every value of right, into a new tree, which is
+        returned, leaving both empty. Two balanced trees are joined in
+        O(height) into a balanced tree. Takes the keyword arguments of the
+        constructor, apart from balanced, which is inherited.
+        '''
+        if left is right:
+            raise ValueError('Cannot join a tree with itself')
+        if not left.is_empty() and not right.is_empty()\
+                and not left.max_node().val < right.min_node().val:
+            raise ValueError('Values of left must all be below values of right')
+        balanced = left.balanced and right.balanced
+        root = _join2(left._take_root(), right._take_root(), balanced)
+        tree = cls(balanced=balanced, **kwargs)
+        tree._adopt(root)
+        return tree
+
+    def union(self, other, destructive=False, **kwargs):
+        '''
+        Returns a new tree with the values found in either tree. Takes
+        O(m + n) for sizes m <= n, as every value is copied, unless the
+        trees are combined destructively, see _combine for the arguments.
+        '''
+        return self._combine(other, _union, (True, True, True), destructive, kwargs)
+
+    def intersection(self, other, destructive=False, **kwargs):
+        '''
+        Returns a new tree with the values found in both trees. The values
+        of the smaller tree are looked up in the larger one, in
+        O(m log(n/m + 1)) for sizes m <= n, unless the trees are combined
+        destructively, see _combine for the arguments.
+        '''
+        if not destructive:
+            small, large = (self, other) if len(self) <= len(other) else (other, self)
+            return self._filter(small, large, True, kwargs)
+        return self._combine(other, _intersection, (False, True, False), destructive, kwargs)
+
+    def difference(self, other, destructive=False, **kwargs):
+        '''
+        Returns a new tree with the values of this tree not found in other.
+        When this tree is the smaller one, its values are looked up in
+        other in O(m log(n/m + 1)), and otherwise the trees are merged in
+        O(m + n), unless they are combined destructively, see _combine for
+        the arguments.
+        '''
+        if not destructive and len(self) <= len(other):
+            return self._filter(self, other, False, kwargs)
+        return self._combine(other, _difference, (True, False, False), destructive, kwargs)
+
+    def _filter(self, tree, other, found, kwargs):
+        '''
+        Returns a new tree of the values of tree that are in other if found
+        is True, or not in other otherwise. All of them are looked up in a
+        single finger search by contains_many, leaving both trees as they
+        are. Takes the keyword arguments of the constructor, with balanced
+        inherited from this tree by default.
+        '''
+        kwargs.setdefault('balanced', self.balanced)
+        values = tree.get_values()
+        return self.__class__.from_sorted(
+                [val for val, contained in zip(values, other.contains_many(values))
+                 if contained is found], **kwargs)
+
+    def _combine(self, other, combine_nodes, keep, destructive, kwargs):
+        '''
+        With destructive=True both trees are emptied and the nodes of the
+        result are taken from them. When the trees and the result are all
+        balanced, the result is built by splitting and joining them in
+        O(m log(n/m + 1)) for sizes m <= n. Otherwise the nodes are merged
+        in O(m + n) and relinked into a perfectly balanced tree. Without
+        destructive the values are merged in O(m + n) into new nodes, which
+        union and difference only do when the result may be as large as
+        both trees. Takes
+        the keyword arguments of the constructor for the new tree, with
+        balanced inherited by default.
+        '''
+        kwargs.setdefault('balanced', self.balanced)
+        if not destructive:
+            return self.__class__.from_sorted(_merge(self, other, *keep), **kwargs)
+        if other is self:
+            raise ValueError('Cannot combine a tree with itself destructively')
+        if self.balanced and other.balanced and kwargs['balanced']:
+            root = combine_nodes(self._take_root(), other._take_root())
+        else:
+            nodes = list(_merge(_iter_nodes(self.root), _iter_nodes(other.root), *keep,
+                                key=attrgetter('val')))
+            self._take_root()
+            other._take_root()
+            root = _relink(nodes, 0, len(nodes), None) if nodes else None
+        tree = self.__class__(**kwargs)
+        tree._adopt(root)
+        return tree
 
-    def _init_graph(self):
-        self.dot = Dot(Bst.dot_file_path)
+    @classmethod
+    def from_sorted(cls, values, **kwargs):
+        '''
+        Builds a perfectly balanced tree from strictly increasing values in
+        O(n). Takes the same keyword arguments as the constructor.
+        '''
+        values = increasing_values(values)
+        tree = cls(**kwargs)
+        if values:
+            # The nodes form reference cycles through their parents, which
+            # would set off a cyclic garbage collection every few hundred
+            # allocations, even though none of them can be garbage yet
+            gc_was_enabled = gc.isenabled()
+            gc.disable()
+            try:
+                tree.root = tree._build(values, 0, len(values), None)
+            finally:
+                if gc_was_enabled:
+                    gc.enable()
+        if tree.observers:
+            tree._notify_rebuilt()
+        return tree
+
+    @classmethod
+    def from_iterable(cls, values, **kwargs):
+        '''
+        Builds a perfectly balanced tree from values in any order, dropping
+        duplicates. Takes O(n log n) for the sort and O(n) for the build.
+        '''
+        return cls.from_sorted(unique_sorted(values), **kwargs)
+
+    def save(self, path, typecode='l'):
+        '''
+        Writes the tree to a snapshot file at path, which is replaced
+        atomically. The values must fit in an array of the given typecode,
+        like 'l' for ints or 'd' for floats.
+        '''
+        values = array(typecode, self.iter_values())
+        shape = bytearray((len(values) + 3) // 4)
+        i = 0
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            bits = (node.left is not None) | (node.right is not None) << 1
+            shape[i >> 2] |= bits << ((i & 3) << 1)
+            i += 1
+            if node.right is not None:
+                stack.append(node.right)
+            if node.left is not None:
+                stack.append(node.left)
+        temp_path = '%s.%s.tmp' % (path, os.getpid())
+        try:
+            with open(temp_path, 'wb') as f:
+                f.write(SNAPSHOT_HEADER.pack(
+                        SNAPSHOT_MAGIC, SNAPSHOT_VERSION, self.balanced, typecode,
+                        values.itemsize, '<' if sys.byteorder == 'little' else '>',
+                        len(values)))
+                values.tofile(f)
+                f.write(shape)
+            os.rename(temp_path, path)
+        except Exception:
+            exc_info = sys.exc_info()
+            # Leave no partial file behind
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        '''
+        Builds the tree saved to a snapshot file at path, with the same
+        shape, in O(n). Takes the keyword arguments of the constructor,
+        apart from balanced, which is read from the file.
+        '''
+        with open(path, 'rb') as f:
+            balanced, typecode, swap, count = _read_snapshot_header(
+                    f.read(SNAPSHOT_HEADER.size))
+            values = array(typecode)
+            data = f.read(count * values.itemsize)
+            shape = bytearray(f.read((count + 3) // 4))
+        if len(data) != count * values.itemsize or len(shape) != (count + 3) // 4:
+            raise ValueError('Snapshot is truncated')
+        values.fromstring(data)
+        if swap:
+            values.byteswap()
+        tree = cls(balanced=bool(balanced), **kwargs)
+        gc_was_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            tree.root = _build_shape(values, shape)
+        finally:
+            if gc_was_enabled:
+                gc.enable()
+        if tree.observers:
+            tree._notify_rebuilt()
+        return tree
+
+    @classmethod
+    def open_mmap(cls, path):
+        '''
+        Maps the snapshot file at path to memory as a read-only MmapBst
+        '''
+        return MmapBst(path)
+
+    def _build(self, values, lo, hi, parent):
+        '''
+        Builds the subtree holding values[lo:hi] and returns its root
+        '''
+        mid = (lo + hi) // 2
+        node = Node(values[mid])
+        node.parent = parent
+        # A subtree built from k values has height k.bit_length()
+        node.height = (hi - lo).bit_length()
+        node.size = hi - lo
+        if lo < mid:
+            node.left = self._build(values, lo, mid, node)
+        if mid + 1 < hi:
+            node.right = self._build(values, mid + 1, hi, node)
+        return node
 
     def is_empty(self):
         return self.root is None
 
+    def __len__(self):
+        return _size(self.root)
+
     def insert(self, val):
-        print 'Attempting to insert %s' % val
-        sleep(5)
+        if self.observers:
+            self._announce('Attempting to insert %s' % val)
         if self.is_empty():
             self.root = Node(val)
-            self.dot.update_node(self.root)
+            if self.observers:
+                self._notify_update(self.root)
             return True
         node = self.root
         while(node is not None):
@@ -111,25 +1064,154 @@ class Bst(object):
                 return False
             if val < node.val:
                 if node.left is None:
-                    node.left = Node(val)
-                    node.left.parent = node
-                    self.dot.update_node(node)
-                    self.dot.update_node(node.left)
+                    self._attach_leaf(node, val)
                     return True
                 else:
                     node = node.left
                     continue
             elif val > node.val:
                 if node.right is None:
-                    node.right = Node(val)
-                    node.right.parent = node
-                    self.dot.update_node(node)
-                    self.dot.update_node(node.right)
+                    self._attach_leaf(node, val)
                     return True
                 else:
                     node = node.right
                     continue
 
+    def _attach_leaf(self, parent, val):
+        '''
+        Adds a node holding val as a child of parent, which must have no
+        child on that side, and returns the new node
+        '''
+        node = Node(val)
+        node.parent = parent
+        if val < parent.val:
+            parent.left = node
+        else:
+            parent.right = node
+        if self.observers:
+            self._notify_update(parent, node)
+        self._resize_path(parent, 1)
+        if self.balanced:
+            self._rebalance(parent)
+        return node
+
+    def _seek(self, finger, hi, val):
+        '''
+        Returns the node holding val, or else the node under which val would
+        be inserted, along with an upper bound of the values its subtree may
+        hold (None when there is none). The search starts from finger instead
+        of the root when given. The range of the subtree under finger must
+        not lie entirely above val, and hi must be at most its upper bound,
+        which holds when both were the result of seeking a smaller value.
+        Only a val at or above hi needs climbing, so a run of values past the
+        end of the tree never goes back up.
+        '''
+        node = finger
+        if node is None:
+            node = self.root
+            hi = None
+            if node is None:
+                return None, None
+        elif hi is not None and val >= hi:
+            # Climb until val is below the upper bound of the subtree
+            hi = None
+            while node.parent is not None:
+                parent = node.parent
+                if node is parent.left and val < parent.val:
+                    hi = parent.val
+                    break
+                node = parent
+        while True:
+            if val == node.val:
+                return node, hi
+            if val < node.val:
+                child = node.left
+                if child is None:
+                    return node, hi
+                hi = node.val
+            else:
+                child = node.right
+                if child is None:
+                    return node, hi
+            node = child
+
+    def insert_many(self, values):
+        '''
+        Inserts a batch of values and returns the list of results insert
+        would have given for each of them, in the order given. The batch is
+        sorted once and each search starts from where the previous one
+        ended, so a run of close values costs far less than separate inserts.
+        '''
+        values = list(values)
+        results = [False] * len(values)
+        finger = hi = None
+        for i in sorted(xrange(len(values)), key=values.__getitem__):
+            val = values[i]
+            if self.observers:
+                self._announce('Attempting to insert %s' % val)
+            node, hi = self._seek(finger, hi, val)
+            if node is None:
+                self.root = finger = Node(val)
+                if self.observers:
+                    self._notify_update(self.root)
+                results[i] = True
+            elif val == node.val:
+                finger = node
+            else:
+                if val < node.val:
+                    hi = node.val
+                # Rotations only widen the range of the new leaf's subtree,
+                # so its successor's value stays a valid bound
+                finger = self._attach_leaf(node, val)
+                results[i] = True
+        return results
+
+    def delete_many(self, values):
+        '''
+        Deletes a batch of values and returns the list of results delete
+        would have given for each of them, in the order given, searching
+        like insert_many
+        '''
+        values = list(values)
+        results = [False] * len(values)
+        finger = hi = None
+        for i in sorted(xrange(len(values)), key=values.__getitem__):
+            val = values[i]
+            if self.observers:
+                self._announce('Attempting to delete %s' % val)
+            node, hi = self._seek(finger, hi, val)
+            if node is not None and val == node.val:
+                # The predecessor survives the deletion and lies below the
+                # remaining values, so the next search can start there, with
+                # the value of the successor as its bound
+                if node.right is not None:
+                    hi = self.min_node(start=node.right).val
+                finger = node.predecessor()
+                if finger is None:
+                    # Deleting the minimum, so start from the next one, which
+                    # has no left child and is bounded by its own value
+                    finger = node.parent if node.right is None \
+                            else self.min_node(start=node.right)
+                    hi = finger.val if finger is not None else None
+                self._delete_node(node)
+                results[i] = True
+            else:
+                finger = node
+        return results
+
+    def contains_many(self, values):
+        '''
+        Returns the list of whether each of a batch of values is in the
+        tree, in the order given, searching like insert_many
+        '''
+        values = list(values)
+        results = [False] * len(values)
+        finger = hi = None
+        for i in sorted(xrange(len(values)), key=values.__getitem__):
+            finger, hi = self._seek(finger, hi, values[i])
+            results[i] = finger is not None and values[i] == finger.val
+        return results
+
     def find_node(self, val):
         if self.is_empty():
             return None
@@ -149,30 +1231,135 @@ class Bst(object):
         '''
         Get values by iterative inorder tree traversal
         '''
+        return list(self.iter_values(start))
+
+    def __iter__(self):
+        return self.iter_values()
+
+    def __reversed__(self):
+        return self.iter_values(reverse=True)
+
+    def iter_values(self, start=None, reverse=False):
+        '''
+        Lazily yields the values of the subtree rooted at the node holding
+        start (the whole tree by default) in order, or in reverse order.
+        Walks the parent pointers, so needs no extra memory.
+        '''
         if start is None:
             start = self.root
         else:
             start = self.find_node(start)
-        values = []
         if start is None:
-            return values
-        temp = start.parent
-        start.parent = None
-        node = start
+            return
+        if reverse:
+            node, last = self.max_node(start), self.min_node(start)
+        else:
+            node, last = self.min_node(start), self.max_node(start)
+        while True:
+            yield node.val
+            if node is last:
+                return
+            node = node.predecessor() if reverse else node.successor()
+
+    def iter_range(self, lo=None, hi=None, reverse=False):
+        '''
+        Lazily yields the values v with lo <= v <= hi in order, or in reverse
+        order. A bound of None leaves that side open. Seeking to the first
+        value takes O(log n) on a balanced tree and every following value
+        takes amortized O(1).
+        '''
+        if reverse:
+            node = self.floor_node(hi)
+            while node is not None and (lo is None or node.val >= lo):
+                yield node.val
+                node = node.predecessor()
+        else:
+            node = self.ceiling_node(lo)
+            while node is not None and (hi is None or node.val <= hi):
+                yield node.val
+                node = node.successor()
+
+    def ceiling_node(self, val=None):
+        '''
+        Returns the node with the smallest value >= val
+        '''
+        if val is None:
+            return self.min_node()
+        node = self.root
+        found = None
+        while node is not None:
+            if val == node.val:
+                return node
+            if val < node.val:
+                found = node
+                node = node.left
+            else:
+                node = node.right
+        return found
+
+    def floor_node(self, val=None):
+        '''
+        Returns the node with the largest value <= val
+        '''
+        if val is None:
+            return self.max_node()
+        node = self.root
+        found = None
         while node is not None:
-            if node.left is not None\
-                    and node.left.val not in values:
+            if val == node.val:
+                return node
+            if val > node.val:
+                found = node
+                node = node.right
+            else:
                 node = node.left
-                continue
-            if node.val not in values:
-                values.append(node.val)
-            if node.right is not None\
-                    and node.right.val not in values:
+        return found
+
+    def rank(self, val):
+        '''
+        Returns the number of values < val in O(height)
+        '''
+        return self._rank(val, False)
+
+    def _rank(self, val, inclusive):
+        node = self.root
+        rank = 0
+        while node is not None:
+            if val == node.val:
+                return rank + _size(node.left) + (1 if inclusive else 0)
+            if val < node.val:
+                node = node.left
+            else:
+                rank += _size(node.left) + 1
                 node = node.right
-                continue
-            node = node.parent
-        start.parent = temp
-        return values
+        return rank
+
+    def select(self, k):
+        '''
+        Returns the node holding the k-th smallest value, counting from 0,
+        in O(height)
+        '''
+        if not 0 <= k < len(self):
+            raise IndexError('Bst index out of range: %s' % k)
+        node = self.root
+        while True:
+            left = _size(node.left)
+            if k == left:
+                return node
+            if k < left:
+                node = node.left
+            else:
+                k -= left + 1
+                node = node.right
+
+    def count_range(self, lo=None, hi=None):
+        '''
+        Returns the number of values v with lo <= v <= hi in O(height).
+        A bound of None leaves that side open.
+        '''
+        below_hi = len(self) if hi is None else self._rank(hi, True)
+        below_lo = 0 if lo is None else self._rank(lo, False)
+        return max(0, below_hi - below_lo)
 
     def min_node(self, start=None):
         if start is None:
@@ -197,63 +1384,316 @@ class Bst(object):
             node = node.right
 
     def delete(self, val):
-        print 'Attempting to delete %s' % val
-        sleep(5)
+        if self.observers:
+            self._announce('Attempting to delete %s' % val)
         node = self.find_node(val)
         if node is None:
             return False
+        self._delete_node(node)
+        return True
+
+    def _delete_node(self, node):
+        if node.left is not None and node.right is not None:
+            # Has both left and right children, so take over the value of the
+            # in-order successor and remove the successor node instead
+            rmin = self.min_node(start=node.right)
+            node.val = rmin.val
+            if self.observers:
+                self._notify_update(node)
+                if node.parent is not None:
+                    self._notify_update(node.parent)
+            node = rmin
+        parent = node.parent
         if node.is_leaf():
             self._remove_leaf(node)
-        elif node.right:
-            if node.left is None:
-                # Only has one right child and no left child
-                if node is self.root:
-                    #Convert right child to root
-                    self.root = node.right
-                    node.right.parent = None
-                    self.dot.update_node(node.right)
-                else:
-                    # Has both left and right children
-                    self._replace_child(node.parent, node, node.right)
-                    self.dot.update_node(node.parent)
-                self.dot.remove_node(node)
-            else:
-                rmin = self.min_node(start=node.right)
-                node.val = rmin.val
-                self.dot.update_node(node)
-                self.dot.update_node(node.parent)
-                self._remove_leaf(rmin)
         else:
-            #only has a left child and no right child
-            if node is self.root:
-                #Convert left child to root
-                self.root = node.left
-                node.left.parent = None
-                self.dot.update_node(node.left)
-            else:
-                self._replace_child(node.parent, node, node.left)
-                self.dot.update_node(node.parent)
-            self.dot.remove_node(node)
-        return True
+            # Only has one child, which takes its place
+            child = node.left if node.left is not None else node.right
+            self._replace_child(parent, node, child)
+            if self.observers:
+                self._notify_update(child if parent is None else parent)
+                self._notify_remove(node)
+        self._resize_path(parent, -1)
+        if self.balanced:
+            self._rebalance(parent)
 
     def _replace_child(self, parent, child, new_child):
-        if child is child.parent.left:
-            child.parent.left = new_child
+        if parent is None:
+            self.root = new_child
+        elif child is parent.left:
+            parent.left = new_child
         else:
-            child.parent.right = new_child
-        new_child.parent = parent
+            parent.right = new_child
+        if new_child is not None:
+            new_child.parent = parent
 
     def _remove_leaf(self, node):
         if node is self.root:
             self.root = None
-            self._init_graph()
+            if self.observers:
+                self._notify_reset()
             return
         if node is node.parent.left:
             node.parent.left = None
         else:
             node.parent.right = None
-        self.dot.update_node(node.parent)
-        self.dot.remove_node(node)
+        if self.observers:
+            self._notify_update(node.parent)
+            self._notify_remove(node)
+
+    def _update_height(self, node):
+        node.height = 1 + max(_height(node.left), _height(node.right))
+
+    def _update_size(self, node):
+        node.size = 1 + _size(node.left) + _size(node.right)
+
+    def _resize_path(self, node, delta):
+        '''
+        Adds delta to the subtree sizes from node up to the root
+        '''
+        while node is not None:
+            node.size += delta
+            node = node.parent
+
+    def _rebalance(self, node):
+        '''
+        Restore the AVL invariant on the path from node up to the root,
+        stopping as soon as a subtree height is left unchanged
+        '''
+        while node is not None:
+            parent = node.parent
+            old_height = node.height
+            balance = _height(node.left) - _height(node.right)
+            if balance > 1:
+                if _height(node.left.left) < _height(node.left.right):
+                    self._rotate_left(node.left)
+                node = self._rotate_right(node)
+            elif balance < -1:
+                if _height(node.right.right) < _height(node.right.left):
+                    self._rotate_right(node.right)
+                node = self._rotate_left(node)
+            else:
+                self._update_height(node)
+            if node.height == old_height:
+                return
+            node = parent
+
+    def _rotate_left(self, node):
+        pivot = node.right
+        node.right = pivot.left
+        if pivot.left is not None:
+            pivot.left.parent = node
+        self._replace_child(node.parent, node, pivot)
+        pivot.left = node
+        node.parent = pivot
+        self._update_height(node)
+        self._update_height(pivot)
+        self._update_size(node)
+        self._update_size(pivot)
+        self._update_rotated(node, pivot)
+        return pivot
+
+    def _rotate_right(self, node):
+        pivot = node.left
+        node.left = pivot.right
+        if pivot.right is not None:
+            pivot.right.parent = node
+        self._replace_child(node.parent, node, pivot)
+        pivot.right = node
+        node.parent = pivot
+        self._update_height(node)
+        self._update_height(pivot)
+        self._update_size(node)
+        self._update_size(pivot)
+        self._update_rotated(node, pivot)
+        return pivot
+
+    def _update_rotated(self, node, pivot):
+        if self.observers:
+            self._notify_update(node, pivot)
+            if pivot.parent is not None:
+                self._notify_update(pivot.parent)
+
+class MmapNode(object):
+    '''
+    Handle to the value at a position of an MmapBst, which stands in for a
+    Node without the links to other nodes
+    '''
+    __slots__ = ('tree', 'index')
+
+    def __init__(self, tree, index):
+        self.tree = tree
+        self.index = index
+
+    def __eq__(self, other):
+        return isinstance(other, MmapNode) and self.tree is other.tree\
+                and self.index == other.index
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((id(self.tree), self.index))
+
+    @property
+    def val(self):
+        return self.tree._val(self.index)
+
+    def successor(self):
+        return self.tree._node(self.index + 1)
+
+    def predecessor(self):
+        return self.tree._node(self.index - 1)
+
+class MmapBst(object):
+    '''
+    Read-only tree over a snapshot written by Bst.save, mapped to memory.
+
+    The values are read straight from the mapped file, where they are in
+    order, so finding one is a binary search of O(log n) whatever the shape
+    of the saved tree. No Node is built, opening it takes O(1), and every
+    process that opens the same file shares its pages.
+    '''
+    # Number of values read at a time when iterating
+    chunk_size = 4096
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            balanced, typecode, swap, count = _read_snapshot_header(
+                    self._mmap[:SNAPSHOT_HEADER.size])
+            if swap:
+                raise ValueError('Snapshot was saved with another byte order, use Bst.load')
+            self.balanced = bool(balanced)
+            self.typecode = typecode
+            self.count = count
+            self._unpack = struct.Struct(typecode).unpack_from
+            self._itemsize = array(typecode).itemsize
+            if len(self._mmap) < SNAPSHOT_HEADER.size + count * self._itemsize:
+                raise ValueError('Snapshot is truncated')
+        except Exception:
+            self._mmap.close()
+            raise
+
+    def close(self):
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def is_empty(self):
+        return self.count == 0
+
+    def _val(self, index):
+        return self._unpack(self._mmap, SNAPSHOT_HEADER.size + index * self._itemsize)[0]
+
+    def _node(self, index):
+        return MmapNode(self, index) if 0 <= index < self.count else None
+
+    def _bisect(self, val, right=False):
+        '''
+        Returns the number of values < val, or <= val if right is True
+        '''
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            mid_val = self._val(mid)
+            if mid_val < val or (right and mid_val == val):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def find_node(self, val):
+        index = self._bisect(val)
+        if index < self.count and self._val(index) == val:
+            return MmapNode(self, index)
+        return None
+
+    def __contains__(self, val):
+        return self.find_node(val) is not None
+
+    def min_node(self):
+        return self._node(0)
+
+    def max_node(self):
+        return self._node(self.count - 1)
+
+    def ceiling_node(self, val=None):
+        '''
+        Returns the node with the smallest value >= val
+        '''
+        return self.min_node() if val is None else self._node(self._bisect(val))
+
+    def floor_node(self, val=None):
+        '''
+        Returns the node with the largest value <= val
+        '''
+        return self.max_node() if val is None else self._node(self._bisect(val, True) - 1)
+
+    def get_values(self):
+        return list(self.iter_values())
+
+    def __iter__(self):
+        return self.iter_values()
+
+    def __reversed__(self):
+        return self.iter_values(reverse=True)
+
+    def iter_values(self, reverse=False):
+        return self._iter_slice(0, self.count, reverse)
+
+    def iter_range(self, lo=None, hi=None, reverse=False):
+        '''
+        Lazily yields the values v with lo <= v <= hi in order, or in reverse
+        order. A bound of None leaves that side open.
+        '''
+        start = 0 if lo is None else self._bisect(lo)
+        stop = self.count if hi is None else self._bisect(hi, True)
+        return self._iter_slice(start, stop, reverse)
+
+    def _iter_slice(self, start, stop, reverse):
+        '''
+        Yields the values at positions start to stop, reading chunk_size of
+        them at a time
+        '''
+        offset = SNAPSHOT_HEADER.size
+        itemsize = self._itemsize
+        chunks = xrange(start, stop, self.chunk_size)
+        for chunk_start in (reversed(chunks) if reverse else chunks):
+            chunk_stop = min(chunk_start + self.chunk_size, stop)
+            values = array(self.typecode, self._mmap[offset + chunk_start * itemsize:
+                                                     offset + chunk_stop * itemsize])
+            for val in (reversed(values) if reverse else values):
+                yield val
+
+def random_updates(tree, rand, count, value_range, check, every=100):
+    '''
+    Makes count random inserts and deletes of values below value_range on
+    tree, six in ten of them inserts, and checks that each returns what it
+    would for a set. Calls check(tree, values) with the set of values every
+    few changes and at the end. Returns the sorted values.
+    '''
+    values = set()
+    for i in xrange(count):
+        val = rand.randrange(value_range)
+        if rand.random() < 0.6:
+            assert tree.insert(val) is (val not in values)
+            values.add(val)
+        else:
+            assert tree.delete(val) is (val in values)
+            values.discard(val)
+        if i % every == 0:
+            check(tree, values)
+    check(tree, values)
+    return sorted(values)
 
 def empty_check(b):
     assert b.is_empty()
@@ -264,11 +1704,11 @@ def empty_check(b):
     assert b.get_values() == []
     assert b.delete(1) is False  # Should not succeed deleting from empty tree
 
-def test_bst():
+def test_bst(headless=True):
     '''
     Method that tests the Bst class
     '''
-    b = Bst()
+    b = Bst(headless=headless)
     empty_check(b)
 
     # Creating 1 element tree
@@ -286,7 +1726,7 @@ def test_bst():
     empty_check(b)
 
     # Removing leaf node
-    b = Bst()
+    b = Bst(headless=headless)
     b.insert(5)
     b.insert(2)
     b.insert(-4)
@@ -309,7 +1749,7 @@ def test_bst():
     assert b.root.left.right.is_leaf()
 
     # Removing node with 1 child
-    b = Bst()
+    b = Bst(headless=headless)
     b.insert(5)
     b.insert(2)
     b.insert(18)
@@ -376,7 +1816,7 @@ def test_bst():
     b.delete(-2)
 
     # Removing node with 2 children
-    b = Bst()
+    b = Bst(headless=headless)
     b.insert(5)
     b.insert(2)
     b.insert(12)
@@ -432,5 +1872,598 @@ def test_bst():
     assert b.root.right.right.right.is_leaf()
     assert b.root.right.right.left is None
 
+def check_tree(b):
+    '''
+    Checks ordering and parent links of the whole tree, along with the AVL
+    invariant for balanced trees and the subtree sizes. Returns the height
+    of the tree.
+    '''
+    def check(node, parent, lo, hi):
+        if node is None:
+            return 0
+        assert node.parent is parent
+        assert lo is None or node.val > lo
+        assert hi is None or node.val < hi
+        left = check(node.left, node, lo, node.val)
+        right = check(node.right, node, node.val, hi)
+        assert node.size == 1 + _size(node.left) + _size(node.right)
+        if b.balanced:
+            assert abs(left - right) <= 1
+            assert node.height == 1 + max(left, right)
+        return 1 + max(left, right)
+    return check(b.root, None, None, None)
+
+def avl_height_bound(n):
+    return 1.44 * log(n + 2, 2) - 0.328
+
+def test_balanced_bst(headless=True):
+    '''
+    Method that tests the height bound of balanced Bst instances under
+    adversarial insert and delete sequences
+    '''
+    n = 63
+    ascending = range(n)
+    descending = range(n, 0, -1)
+    zigzag = [val for pair in zip(range(n), range(2 * n, n, -1)) for val in pair]
+    for values in [ascending, descending, zigzag]:
+        b = Bst(balanced=True, headless=headless)
+        empty_check(b)
+        for count, val in enumerate(values, 1):
+            assert b.insert(val) is True
+            assert check_tree(b) <= avl_height_bound(count)
+        assert b.get_values() == sorted(values)
+        assert b.insert(values[0]) is False
+        # Delete the smallest values first so that the tree keeps leaning
+        remaining = sorted(values)
+        while remaining:
+            assert b.delete(remaining.pop(0)) is True
+            assert check_tree(b) <= avl_height_bound(len(remaining))
+            assert b.get_values() == remaining
+        empty_check(b)
+
+    # Deleting nodes with two children from the middle of the tree
+    b = Bst(balanced=True, headless=headless)
+    for val in ascending:
+        b.insert(val)
+    for val in ascending[n // 2:] + ascending[:n // 2]:
+        assert b.delete(val) is True
+        check_tree(b)
+    empty_check(b)
+
+def test_iteration(headless=True):
+    '''
+    Method that tests the lazy iterators and range scans
+    '''
+    b = Bst(headless=headless)
+    assert list(b) == []
+    assert list(reversed(b)) == []
+    assert list(b.iter_range(1, 5)) == []
+    assert b.ceiling_node(1) is None
+    assert b.floor_node(1) is None
+    for val in [5, 2, 12, -4, 3, 9, 21, 19, 25]:
+        b.insert(val)
+    values = [-4, 2, 3, 5, 9, 12, 19, 21, 25]
+    assert list(b) == values
+    assert list(reversed(b)) == values[::-1]
+    assert list(b.iter_values(12)) == [9, 12, 19, 21, 25]
+    assert list(b.iter_values(12, reverse=True)) == [25, 21, 19, 12, 9]
+    assert list(b.iter_values(7)) == []
+    assert list(b.iter_range(3, 19)) == [3, 5, 9, 12, 19]
+    assert list(b.iter_range(4, 18)) == [5, 9, 12]
+    assert list(b.iter_range(4, 18, reverse=True)) == [12, 9, 5]
+    assert list(b.iter_range(hi=2)) == [-4, 2]
+    assert list(b.iter_range(lo=20)) == [21, 25]
+    assert list(b.iter_range(lo=20, reverse=True)) == [25, 21]
+    assert list(b.iter_range(26, 30)) == []
+    assert list(b.iter_range(10, 8)) == []
+    assert b.ceiling_node(10).val == 12
+    assert b.floor_node(10).val == 9
+    assert b.ceiling_node(26) is None
+    assert b.floor_node(-5) is None
+    # Iteration must leave the parent pointers alone
+    parents = [(node, node.parent) for node in [b.root, b.root.left, b.root.right]]
+    b.get_values(2)
+    assert all(node.parent is parent for node, parent in parents)
+
+def node_record(node):
+    return (node.val,
+            None if node.left is None else node.left.val,
+            None if node.right is None else node.right.val)
+
+class RecordingObserver(TreeObserver):
+    def __init__(self):
+        self.nodes = {}
+        self.messages = []
+
+    def reset(self):
+        self.nodes = {}
+
+    def update_node(self, node):
+        self.nodes[node] = node_record(node)
+
+    def remove_node(self, node):
+        del self.nodes[node]
+
+    def announce(self, msg):
+        self.messages.append(msg)
+
+def test_observers():
+    '''
+    Method that tests that observers are kept in sync with the tree
+    '''
+    b = Bst(headless=True)
+    assert b.observers == []
+    for val in [5, 2, 12]:
+        b.insert(val)
+    recorder = b.attach(RecordingObserver())
+    assert sorted(record[0] for record in recorder.nodes.values()) == [2, 5, 12]
+    for val in [-4, 3, 9, 21, 19, 25]:
+        b.insert(val)
+    for val in [12, 2, 5, 100]:
+        b.delete(val)
+    assert recorder.messages[0] == 'Attempting to insert -4'
+    assert recorder.messages[-1] == 'Attempting to delete 100'
+
+    def check_in_sync(b, recorder):
+        expected = {}
+        node = b.min_node()
+        while node is not None:
+            expected[node] = node_record(node)
+            node = node.successor()
+        assert recorder.nodes == expected
+    check_in_sync(b, recorder)
+
+    b = Bst(balanced=True, headless=True)
+    recorder = b.attach(RecordingObserver())
+    for val in range(20):
+        b.insert(val)
+        check_in_sync(b, recorder)
+    for val in range(20):
+        b.delete(val)
+        check_in_sync(b, recorder)
+    b.detach(recorder)
+    b.insert(1)
+    assert recorder.nodes == {}
+
+class RecordingDot(Dot):
+    """
+    Dot that keeps the rendered frames in memory, rendering slowly
+    """
+    def __init__(self, render_interval):
+        self.frames = []
+        Dot.__init__(self, None, render_interval=render_interval)
+
+    def _render(self, dot_strs):
+        sleep(0.01)
+        self.frames.append(''.join(dot_strs))
+
+def test_async_dot():
+    '''
+    Method that tests that the background renderer coalesces changes
+    '''
+    b = Bst(balanced=True, headless=True)
+    dot = b.attach(RecordingDot(render_interval=0.05))
+    for val in range(200):
+        b.insert(val)
+    for val in range(0, 200, 2):
+        b.delete(val)
+    dot.flush()
+    # Far fewer renders than the changes made, and the last one is current
+    assert 0 < len(dot.frames) < 50
+    assert len(dot.nodes) == 100
+    assert dot.frames[-1] == ''.join(dot.nodes.values())
+    frames = len(dot.frames)
+    dot.flush()
+    assert len(dot.frames) == frames  # Nothing left to render
+    b.insert(1000)
+    dot.close()
+    assert len(dot.frames) > frames
+    assert dot.frames[-1] == ''.join(dot.nodes.values())
+    # A closed renderer still attached to the tree renders nothing more
+    frames = len(dot.frames)
+    b.insert(1001)
+    b.delete(1000)
+    dot.flush()
+    dot.close()
+    assert len(dot.frames) == frames
+
+def test_bulk_load(headless=True):
+    '''
+    Method that tests building trees from sorted and unsorted values
+    '''
+    for balanced in [False, True]:
+        b = Bst.from_sorted([], balanced=balanced, headless=headless)
+        empty_check(b)
+        b = Bst.from_sorted([7], balanced=balanced, headless=headless)
+        assert b.root.val == 7
+        assert b.root.is_leaf()
+        for n in [2, 3, 10, 100, 1000]:
+            b = Bst.from_sorted(xrange(n), balanced=balanced, headless=headless)
+            assert b.balanced == balanced
+            assert check_tree(b) == int(log(n, 2)) + 1  # Perfectly balanced
+            assert b.get_values() == range(n)
+        # Bulk loaded trees behave like any other tree
+        assert b.insert(1000) is True
+        assert b.delete(500) is True
+        check_tree(b)
+        b = Bst.from_iterable([5, 3, 9, 3, 1, 9, 5], balanced=balanced, headless=headless)
+        assert b.get_values() == [1, 3, 5, 9]
+        check_tree(b)
+    for values in [[1, 1], [2, 1], [1, 3, 2]]:
+        try:
+            Bst.from_sorted(values, headless=headless)
+            assert False, 'Unsorted values should be rejected'
+        except ValueError:
+            pass
+
+def test_order_statistics(headless=True):
+    '''
+    Method that tests rank, select and count_range against a sorted list
+    '''
+    for balanced in [False, True]:
+        b = Bst(balanced=balanced, headless=headless)
+        assert len(b) == 0
+        assert b.rank(5) == 0
+        assert b.count_range(1, 10) == 0
+        try:
+            b.select(0)
+            assert False, 'Selecting from an empty tree should fail'
+        except IndexError:
+            pass
+        values = []
+        for val in [50, 20, 80, 10, 30, 70, 90, 25, 35, 5, 95, 60]:
+            b.insert(val)
+            values.append(val)
+        for val in [20, 90, 50, 33]:
+            b.delete(val)
+            if val in values:
+                values.remove(val)
+        values.sort()
+        check_tree(b)
+        assert len(b) == len(values)
+        for k, val in enumerate(values):
+            assert b.select(k).val == val
+            assert b.rank(val) == k
+            assert b.rank(val + 1) == k + 1
+        assert b.rank(0) == 0
+        assert b.rank(100) == len(values)
+        for lo, hi in [(0, 100), (10, 70), (11, 69), (26, 34), (96, 99), (70, 10)]:
+            assert b.count_range(lo, hi) == len([v for v in values if lo <= v <= hi])
+        assert b.count_range(hi=30) == len([v for v in values if v <= 30])
+        assert b.count_range(lo=30) == len([v for v in values if v >= 30])
+        assert b.count_range() == len(values)
+        try:
+            b.select(len(values))
+            assert False, 'Selecting past the end should fail'
+        except IndexError:
+            pass
+    b = Bst.from_sorted(range(100), balanced=True, headless=headless)
+    check_tree(b)
+    assert b.select(42).val == 42
+    assert b.count_range(10, 19) == 10
+
+def test_batches(headless=True):
+    '''
+    Method that tests the batch operations against single operations
+    '''
+    rand = random.Random(3)
+    for balanced in [False, True]:
+        b = Bst(balanced=balanced, headless=headless)
+        single = Bst(balanced=balanced, headless=headless)
+        assert b.contains_many([1, 2]) == [False, False]
+        assert b.delete_many([1, 2]) == [False, False]
+        for _ in xrange(30):
+            batch = [rand.randrange(200) for _ in xrange(rand.randrange(1, 40))]
+            if rand.random() < 0.6:
+                expected = [single.insert(val) for val in batch]
+                assert b.insert_many(batch) == expected
+            else:
+                expected = [single.delete(val) for val in batch]
+                assert b.delete_many(batch) == expected
+            check_tree(b)
+            assert b.get_values() == single.get_values()
+            probe = [rand.randrange(-10, 210) for _ in xrange(20)]
+            assert b.contains_many(probe) == \
+                    [single.find_node(val) is not None for val in probe]
+        # Sorted batches into a large tree
+        b = Bst.from_sorted(range(0, 1000, 2), balanced=balanced, headless=headless)
+        assert b.insert_many(range(500, 600)) == [val % 2 == 1 for val in range(500, 600)]
+        assert b.delete_many(range(550, 650)) == [True] * 50 + [val % 2 == 0 for val in range(600, 650)]
+        check_tree(b)
+        assert b.get_values() == range(0, 500, 2) + range(500, 550) + range(650, 1000, 2)
+        values = b.get_values()
+        assert b.delete_many(values) == [True] * len(values)
+        empty_check(b)
+
+    # A sorted batch past the largest value, like new timestamps, must not
+    # climb back to the root for every value
+    class Counted(object):
+        comparisons = [0]
+        def __init__(self, val):
+            self.val = val
+        def __cmp__(self, other):
+            self.comparisons[0] += 1
+            return cmp(self.val, other.val)
+        def __hash__(self):
+            return hash(self.val)
+    n, k = 1 << 14, 1000
+    b = Bst.from_sorted([Counted(val) for val in xrange(n)], balanced=True, headless=headless)
+    height = b.root.height
+    for batch in [xrange(n, n + k), xrange(n + k, n + 2 * k, 2)]:
+        Counted.comparisons[0] = 0
+        assert b.contains_many([Counted(val) for val in batch]) == [False] * len(batch)
+        # Sorting the batch takes one comparison per value, and each
+        # search about three
+        assert Counted.comparisons[0] <= 5 * len(batch) + 2 * height
+        Counted.comparisons[0] = 0
+        assert b.insert_many([Counted(val) for val in batch]) == [True] * len(batch)
+        assert Counted.comparisons[0] <= 7 * len(batch) + 2 * height
+    check_tree(b)
+    Counted.comparisons[0] = 0
+    assert b.delete_many([Counted(val) for val in xrange(n + 2 * k)]) == \
+            [True] * (n + k) + [val % 2 == 0 for val in xrange(k)]
+    assert Counted.comparisons[0] <= 7 * (n + 2 * k)
+    empty_check(b)
+
+def test_set_algebra(headless=True):
+    '''
+    Method that tests split, join, union, intersection and difference
+    against python sets
+    '''
+    rand = random.Random(11)
+    for balanced in [False, True]:
+        def tree(values):
+            b = Bst(balanced=balanced, headless=headless)
+            for val in values:
+                b.insert(val)
+            return b
+
+        # Splitting and joining back
+        for n in [0, 1, 2, 50]:
+            values = rand.sample(xrange(1000), n)
+            for val in [-1, 500, 1000] + values[:3]:
+                b = tree(values)
+                left, right = b.split(val, headless=headless)
+                empty_check(b)
+                assert left.balanced == right.balanced == balanced
+                check_tree(left)
+                check_tree(right)
+                assert left.get_values() == sorted(v for v in values if v < val)
+                assert right.get_values() == sorted(v for v in values if v >= val)
+                joined = Bst.join(left, right, headless=headless)
+                assert left.is_empty() and right.is_empty()
+                assert joined.balanced == balanced
+                check_tree(joined)
+                assert joined.get_values() == sorted(values)
+        try:
+            Bst.join(tree([1, 5]), tree([3]))
+            assert False, 'Overlapping trees should not be joined'
+        except ValueError:
+            pass
+        # Joining trees of very different heights
+        joined = Bst.join(tree(range(100)), tree([1000]), headless=headless)
+        assert check_tree(joined) <= (avl_height_bound(101) if balanced else 101)
+        joined = Bst.join(tree([-1]), tree(range(100)), headless=headless)
+        assert check_tree(joined) <= (avl_height_bound(101) if balanced else 101)
+
+        for _ in xrange(20):
+            a_values = set(rand.sample(xrange(200), rand.randrange(50)))
+            b_values = set(rand.sample(xrange(200), rand.randrange(120)))
+            for name, expected in [('union', a_values | b_values),
+                                   ('intersection', a_values & b_values),
+                                   ('difference', a_values - b_values)]:
+                a, b = tree(a_values), tree(b_values)
+                result = getattr(a, name)(b, headless=headless)
+                check_tree(result)
+                assert result.get_values() == sorted(expected)
+                assert a.get_values() == sorted(a_values)
+                assert b.get_values() == sorted(b_values)
+                result = getattr(a, name)(b, destructive=True, headless=headless)
+                assert result.balanced == balanced
+                check_tree(result)
+                assert result.get_values() == sorted(expected)
+                assert a.is_empty() and b.is_empty()
+
+    # A small tree combined destructively with a large one
+    big = Bst.from_sorted(xrange(0, 100000, 2), balanced=True, headless=headless)
+    small = Bst.from_sorted(xrange(0, 100000, 1000), balanced=True, headless=headless)
+    result = big.difference(small, destructive=True, headless=headless)
+    check_tree(result)
+    assert len(result) == 50000 - 100
+    assert result.find_node(1000) is None
+    assert result.find_node(1002).val == 1002
+    # Without destructive, the small tree's values are looked up in the big one
+    big = Bst.from_sorted(xrange(0, 100000, 2), balanced=True, headless=headless)
+    small = Bst.from_sorted(xrange(0, 100000, 1000), balanced=True, headless=headless)
+    assert big.intersection(small, headless=headless).get_values() == range(0, 100000, 1000)
+    assert small.difference(big, headless=headless).is_empty()
+    assert small.difference(Bst.from_sorted([0, 5000], headless=headless), headless=headless)\
+            .get_values() == [v for v in xrange(0, 100000, 1000) if v not in (0, 5000)]
+    assert len(big) == 50000 and len(small) == 100
+    check_tree(big)
+    # Unbalanced or mixed trees are combined by relinking their own nodes
+    for balanced in [False, True]:
+        a = Bst(headless=headless)
+        for val in range(0, 60, 3):
+            a.insert(val)
+        b = Bst.from_sorted(range(0, 60, 2), balanced=balanced, headless=headless)
+        nodes = set(_iter_nodes(a.root)) | set(_iter_nodes(b.root))
+        result = a.union(b, destructive=True, balanced=True, headless=headless)
+        assert result.balanced
+        check_tree(result)
+        assert result.get_values() == sorted(set(range(0, 60, 3)) | set(range(0, 60, 2)))
+        assert set(_iter_nodes(result.root)) <= nodes
+
+def test_instrumentation(headless=True):
+    '''
+    Method that tests the statistics kept by an instrumented tree
+    '''
+    b = Bst(balanced=True, headless=headless)
+    assert b.stats is None and 'insert' not in vars(b)
+    events = []
+    stats = b.instrument(callback=lambda *event: events.append(event))
+    assert b.stats is stats
+    for val in [2, 1, 3, 4, 5]:
+        assert b.insert(val)
+    assert not b.insert(4)
+    check_tree(b)
+    assert b.get_values() == [1, 2, 3, 4, 5]
+    # Inserting 5 under 4, under 3, rotates 3 left
+    assert stats.rotations == {'left': 1}
+    assert events[-2] == ('insert', 5, 6, 3)
+    assert events[-1] == ('insert', 4, 3, 2)
+    assert b.find_node(2).val == 2
+    assert b.find_node(7) is None
+    assert events[-1] == ('find', 7, 6, 3)
+    assert b.delete(1) and not b.delete(1)
+    check_tree(b)
+    snapshot = stats.snapshot()
+    assert snapshot['nodes'] == 4 and snapshot['height'] == 3
+    assert snapshot['operations'] == {'insert': 6, 'find': 2, 'delete': 2}
+    assert snapshot['comparisons']['insert'] == 0 + 2 + 2 + 4 + 6 + 3
+    assert snapshot['mean_comparisons']['find'] == (1 + 6) / 2.0
+    assert snapshot['max_comparisons']['insert'] == 6
+    assert sum(snapshot['depths'].values()) == len(events) == 10
+    assert snapshot['max_depth'] == 3
+
+    # Stopping leaves the plain methods, with the tree unchanged
+    assert b.uninstrument() is stats
+    assert b.stats is None and 'insert' not in vars(b)
+    b.insert(10)
+    assert len(events) == 10
+    assert b.get_values() == [2, 3, 4, 5, 10]
+
+    # An unbalanced tree of sorted values is as deep as it is large
+    b = Bst(headless=headless)
+    stats = b.instrument()
+    for val in xrange(50):
+        b.insert(val)
+    snapshot = stats.snapshot()
+    assert snapshot['height'] == snapshot['max_depth'] + 1 == 50
+    assert snapshot['rotations'] == {}
+    stats.reset()
+    assert stats.snapshot()['operations'] == {}
+
+def test_snapshots(headless=True):
+    '''
+    Method that tests saving trees to snapshots, loading them back and
+    mapping them to memory
+    '''
+    rand = random.Random(23)
+    fd, path = tempfile.mkstemp(suffix='.bst')
+    os.close(fd)
+
+    def preorder(node):
+        stack = [node] if node is not None else []
+        while stack:
+            node = stack.pop()
+            yield node.val
+            stack.extend(child for child in (node.right, node.left) if child is not None)
+
+    try:
+        for balanced in [False, True]:
+            for n in [0, 1, 2, 3, 10, 1000]:
+                b = Bst(balanced=balanced, headless=headless)
+                for val in rand.sample(xrange(-n, 4 * n + 1), 2 * n):
+                    b.insert(val)
+                for val in rand.sample(b.get_values(), n):
+                    b.delete(val)
+                values = b.get_values()
+                b.save(path)
+                loaded = Bst.load(path, headless=headless)
+                assert loaded.balanced == balanced
+                check_tree(loaded)
+                assert list(preorder(loaded.root)) == list(preorder(b.root))
+                assert loaded.get_values() == values
+                assert [loaded.select(k).val for k in xrange(n)] == values
+
+                with Bst.open_mmap(path) as mapped:
+                    assert len(mapped) == n and mapped.is_empty() == (n == 0)
+                    assert mapped.balanced == balanced
+                    assert mapped.get_values() == values
+                    assert list(reversed(mapped)) == values[::-1]
+                    if n:
+                        assert mapped.min_node().val == values[0]
+                        assert mapped.max_node().val == values[-1]
+                    for val in xrange(-n - 1, 4 * n + 2, max(1, n // 50)):
+                        node = mapped.find_node(val)
+                        assert (node and node.val) == (b.find_node(val) and val)
+                        for name in ['ceiling_node', 'floor_node']:
+                            expected = getattr(b, name)(val)
+                            found = getattr(mapped, name)(val)
+                            assert (found and found.val) == (expected and expected.val)
+                    for _ in xrange(20):
+                        lo, hi = sorted(rand.randint(-n - 1, 4 * n + 1) for i in xrange(2))
+                        for reverse in [False, True]:
+                            assert list(mapped.iter_range(lo, hi, reverse)) == \
+                                    list(b.iter_range(lo, hi, reverse))
+                    assert list(mapped.iter_range(hi=n)) == list(b.iter_range(hi=n))
+                    node = mapped.min_node()
+                    walked = []
+                    while node is not None:
+                        walked.append(node.val)
+                        node = node.successor()
+                    assert walked == values
+
+        # Values are read in chunks when iterating
+        b = Bst.from_sorted([i / 4.0 for i in xrange(10000)], headless=headless)
+        b.save(path, typecode='d')
+        with Bst.open_mmap(path) as mapped:
+            assert mapped.find_node(2.25).val == 2.25
+            assert mapped.find_node(2.3) is None
+            assert list(mapped.iter_range(1000, 2000.5)) == list(b.iter_range(1000, 2000.5))
+            assert list(reversed(mapped)) == list(reversed(b))
+        assert Bst.load(path, headless=headless).get_values() == b.get_values()
+
+        # Files that are not snapshots
+        with open(path, 'wb') as f:
+            f.write('not a snapshot of anything')
+        fds = '/proc/self/fd'
+        open_fds = len(os.listdir(fds)) if os.path.isdir(fds) else None
+        for read in [lambda: Bst.load(path, headless=True), lambda: Bst.open_mmap(path)]:
+            try:
+                read()
+                assert False, 'Files that are not snapshots should be rejected'
+            except ValueError:
+                pass
+        # The rejected mapping was closed, along with its file descriptor
+        assert open_fds is None or len(os.listdir(fds)) == open_fds
+
+        # A failed save leaves neither the target nor a temporary file
+        directory = tempfile.mkdtemp()
+        try:
+            target = os.path.join(directory, 'taken')
+            os.mkdir(target)
+            try:
+                Bst.from_sorted(xrange(10), headless=True).save(target)
+                assert False, 'Saving over a directory should fail'
+            except OSError:
+                pass
+            assert os.listdir(directory) == ['taken']
+        finally:
+            shutil.rmtree(directory)
+        Bst.from_sorted(xrange(100), headless=True).save(path)
+        with open(path, 'r+b') as f:
+            f.truncate(os.path.getsize(path) - 1)
+        try:
+            Bst.load(path, headless=True)
+            assert False, 'Truncated snapshots should be rejected'
+        except ValueError:
+            pass
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
 if __name__ == '__main__':
-    test_bst()
+    headless = '--visual' not in sys.argv
+    test_bst(headless)
+    test_balanced_bst(headless)
+    test_iteration(headless)
+    test_observers()
+    test_async_dot()
+    test_bulk_load(headless)
+    test_order_statistics(headless)
+    test_batches(headless)
+    test_set_algebra(headless)
+    test_instrumentation(headless)
+    test_snapshots(headless)
@@ -0,0 +1,360 @@
+#!/usr/bin/env python
+
+"""
+Benchmark of bst.Bst, and of array_bst.ArrayBst and btree.BPlusTree for
+comparison
+
+Every workload inserts n distinct keys in some order into a headless tree,
+then looks all of them up, iterates over the tree and deletes every key
+in random order:
+    random       Keys in random order.
+    sorted       Keys in increasing order.
+    reverse      Keys in decreasing order.
+    zigzag       Smallest, largest, second smallest, second largest...
+    delete_heavy Random keys, then n rounds of deleting a key and
+                 inserting a new one before the final deletes.
+
+For every kind of tree, workload and size, the time per operation of each
+phase is reported, along with the height of the tree once filled and the
+memory used. Every run goes in a child process of its own, and the peak
+memory is the growth of its maximum resident set size, which is shown as
+'-' where it cannot be read.
+
+A run over its time budget, like an unbalanced tree fed sorted keys, is
+stopped and the larger sizes are skipped for that tree and workload. So
+are they after a run whose child process died, killed by the OOM killer
+for one, which is recorded as failed.
+
+Running with --profile prints the functions that took the most time in
+every run. Running with --tracemalloc (from pytracemalloc on Python 2)
+runs every workload a second time, untimed as tracing slows it down, to
+measure the peak memory with tracemalloc instead and print the lines
+that allocated the most.
+Running with --output FILE writes the results as JSON.
+
+"""
+
+__author__ = "Orko Garai (orko.garai@gmail.com)"
+
+from Queue import Empty
+from timeit import default_timer
+import argparse
+import cProfile
+import json
+import multiprocessing
+import pstats
+import random
+import signal
+import sys
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from array_bst import ArrayBst, bst_memory_size
+from bst import Bst
+from btree import BPlusTree
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+
+TREES = [('bst', lambda: Bst(headless=True)),
+         ('avl', lambda: Bst(balanced=True, headless=True)),
+         ('array', lambda: ArrayBst()),
+         ('array_avl', lambda: ArrayBst(balanced=True)),
+         ('btree', lambda: BPlusTree()),
+         ('btree_array', lambda: BPlusTree(typecode='l'))]
+
+def random_keys(n, rand):
+    return rand.sample(xrange(10 * n), n)
+
+def sorted_keys(n, rand):
+    return range(n)
+
+def reverse_keys(n, rand):
+    return range(n - 1, -1, -1)
+
+def zigzag_keys(n, rand):
+    keys = []
+    lo, hi = 0, n - 1
+    while lo <= hi:
+        keys.append(lo)
+        if lo != hi:
+            keys.append(hi)
+        lo += 1
+        hi -= 1
+    return keys
+
+WORKLOADS = [('random', random_keys), ('sorted', sorted_keys),
+             ('reverse', reverse_keys), ('zigzag', zigzag_keys),
+             ('delete_heavy', random_keys)]
+
+class TimedOut(Exception):
+    pass
+
+class MeasurementFailed(Exception):
+    pass
+
+def _time_out(signum, frame):
+    raise TimedOut()
+
+def tree_height(tree):
+    '''
+    Returns the height of the tree, counting the nodes on its longest path
+    '''
+    if isinstance(tree, BPlusTree):
+        return tree.height()
+    height = 0
+    level = [tree.root] if tree.root is not None else []
+    while level:
+        height += 1
+        level = [child for node in level for child in (node.left, node.right)
+                 if child is not None]
+    return height
+
+def tree_memory(tree):
+    if isinstance(tree, (ArrayBst, BPlusTree)):
+        return tree.memory_size()
+    return bst_memory_size(tree)
+
+def _timed(timings, phase, ops, func, *args):
+    start = default_timer()
+    func(*args)
+    timings[phase] = (default_timer() - start) * 1e6 / max(ops, 1)
+
+def run_workload(make_tree, name, n, seed=0):
+    '''
+    Runs a workload on a new tree
+    @return: A dict of the microseconds per operation of every phase, the
+             height of the filled tree and its size in bytes
+    '''
+    rand = random.Random(seed)
+    keys = dict(WORKLOADS)[name](n, rand)
+    lookups = keys[:]
+    rand.shuffle(lookups)
+    tree = make_tree()
+    timings = {}
+
+    def insert(values):
+        for val in values:
+            tree.insert(val)
+
+    def find(values):
+        for val in values:
+            tree.find_node(val)
+
+    def traverse():
+        for val in tree:
+            pass
+
+    def delete(values):
+        for val in values:
+            tree.delete(val)
+
+    def churn(values, new_values):
+        for val, new_val in zip(values, new_values):
+            tree.delete(val)
+            tree.insert(new_val)
+
+    _timed(timings, 'insert', n, insert, keys)
+    height = tree_height(tree)
+    memory = tree_memory(tree)
+    _timed(timings, 'find', n, find, lookups)
+    _timed(timings, 'traverse', n, traverse)
+    if name == 'delete_heavy':
+        # The first keys are all below 10 * n
+        new_keys = rand.sample(xrange(10 * n, 20 * n), n)
+        _timed(timings, 'churn', 2 * n, churn, lookups, new_keys)
+        lookups = new_keys[:]
+        rand.shuffle(lookups)
+    _timed(timings, 'delete', n, delete, lookups)
+    assert tree.is_empty()
+    return {'phases': timings, 'height': height, 'tree_bytes': memory}
+
+def measure(make_tree, name, n, budget=None, profile=False, trace=False):
+    '''
+    Runs a workload with the peak memory measured, and profiled if asked.
+    With trace, the peak is measured by tracemalloc in a second run that
+    is not timed.
+    @return: The result of run_workload with the peak memory added, or None
+             if it ran over budget seconds
+    @raise MeasurementFailed: If the run failed or its child process died
+    '''
+    if resource is not None:
+        # The maximum resident set size never goes down, so it only tells
+        # the peak of this run in a process that ran nothing before
+        result = _in_child(_measure, make_tree, name, n, budget, profile)
+    else:
+        result = _measure(make_tree, name, n, budget, profile)
+    if result is not None and trace:
+        result['peak_bytes'] = _traced_peak(make_tree, name, n)
+    return result
+
+def _in_child(func, *args):
+    '''
+    Calls func(*args) in a forked child process and returns its result
+    @raise MeasurementFailed: If func raised or the child died before
+                              returning a result
+    '''
+    queue = multiprocessing.Queue()
+    def target():
+        try:
+            queue.put((True, func(*args)))
+        except BaseException as e:
+            queue.put((False, '%s: %s' % (type(e).__name__, e)))
+    child = multiprocessing.Process(target=target)
+    # Or the child would print the output buffered so far again
+    sys.stdout.flush()
+    child.start()
+    while True:
+        # A child that was killed never puts anything, so only wait for
+        # the result while it is alive
+        alive = child.is_alive()
+        try:
+            succeeded, result = queue.get(timeout=1.0)
+            break
+        except Empty:
+            if not alive:
+                child.join()
+                if child.exitcode < 0:
+                    reason = 'was killed by signal %s' % -child.exitcode
+                else:
+                    reason = 'exited with code %s' % child.exitcode
+                raise MeasurementFailed('The child process %s' % reason)
+    child.join()
+    if not succeeded:
+        raise MeasurementFailed('Measurement failed in the child process: %s' % result)
+    return result
+
+def _measure(make_tree, name, n, budget, profile):
+    alarm = budget is not None and hasattr(signal, 'setitimer')
+    profiler = cProfile.Profile() if profile else None
+    if resource is not None:
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if alarm:
+        previous_handler = signal.signal(signal.SIGALRM, _time_out)
+        signal.setitimer(signal.ITIMER_REAL, budget)
+    try:
+        if profiler:
+            profiler.enable()
+        try:
+            result = run_workload(make_tree, name, n)
+        finally:
+            if profiler:
+                profiler.disable()
+    except TimedOut:
+        return None
+    finally:
+        if alarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous_handler)
+    if resource is not None:
+        # ru_maxrss is in bytes on OS X and in kilobytes elsewhere
+        unit = 1 if sys.platform == 'darwin' else 1024
+        result['peak_bytes'] = unit * (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                                       - rss_before)
+    else:
+        result['peak_bytes'] = None
+    if profiler:
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(15)
+    return result
+
+def _traced_peak(make_tree, name, n):
+    '''
+    Runs a workload again with tracemalloc on, and prints the lines that
+    allocated the most
+    @return: The peak of the traced memory in bytes
+    '''
+    tracemalloc.start(25)
+    try:
+        run_workload(make_tree, name, n)
+        peak = tracemalloc.get_traced_memory()[1]
+        snapshot = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    for stat in snapshot.statistics('lineno')[:10]:
+        print '    %s' % stat
+    return peak
+
+def run(sizes, trees=None, workloads=None, budget=60.0, profile=False, trace=False):
+    '''
+    Runs every workload on every tree at every size, printing the results
+    as they come
+    @return: The list of results, each a dict with the tree, workload and
+             size, and timed_out or failed set or the measurements of
+             'measure'
+    '''
+    results = []
+    phases = ['insert', 'find', 'traverse', 'churn', 'delete']
+    print 'Microseconds per operation of every phase:'
+    for workload, keys in WORKLOADS:
+        if workloads and workload not in workloads:
+            continue
+        print workload
+        print '    %-10s %9s %7s %8s %8s %s' % (
+                'tree', 'size', 'height', 'tree MB', 'peak MB',
+                ' '.join('%9s' % phase for phase in phases))
+        for tree_name, make_tree in TREES:
+            if trees and tree_name not in trees:
+                continue
+            stopped = None
+            for size in sizes:
+                if stopped:
+                    print '    %-10s %9s skipped' % (tree_name, size)
+                else:
+                    try:
+                        result = measure(make_tree, workload, size, budget, profile, trace)
+                    except MeasurementFailed as e:
+                        stopped = {'failed': True, 'error': str(e), 'timed_out': False}
+                        print '    %-10s %9s failed: %s' % (tree_name, size, e)
+                    else:
+                        if result is None:
+                            stopped = {'failed': False, 'timed_out': True}
+                            print '    %-10s %9s timed out' % (tree_name, size)
+                if stopped:
+                    result = {'tree': tree_name, 'workload': workload, 'size': size}
+                    result.update(stopped)
+                    results.append(result)
+                    continue
+                result.update({'tree': tree_name, 'workload': workload,
+                               'size': size, 'timed_out': False, 'failed': False})
+                results.append(result)
+                peak = result['peak_bytes']
+                print '    %-10s %9s %7s %8.1f %8s %s' % (
+                        tree_name, size, result['height'], result['tree_bytes'] / 1e6,
+                        '%.1f' % (peak / 1e6) if peak is not None else '-',
+                        ' '.join('%9s' % ('%.2f' % result['phases'][phase]
+                                          if phase in result['phases'] else '-')
+                                 for phase in phases))
+    return results
+
+def main(args):
+    parser = argparse.ArgumentParser(description='Benchmark the BST implementations')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help='the numbers of keys, up to 10**7 memory permitting')
+    parser.add_argument('--trees', nargs='+', choices=[name for name, make in TREES])
+    parser.add_argument('--workloads', nargs='+', choices=[name for name, keys in WORKLOADS])
+    parser.add_argument('--budget', type=float, default=60.0,
+                        help='the seconds a run may take before larger sizes are skipped')
+    parser.add_argument('--profile', action='store_true',
+                        help='print the functions that took the most time in every run')
+    parser.add_argument('--tracemalloc', action='store_true',
+                        help='measure the peak memory with tracemalloc in an untimed '
+                             'second run, and print the lines that allocated the most')
+    parser.add_argument('--output', help='the JSON file to write the results to')
+    options = parser.parse_args(args)
+    if options.tracemalloc and tracemalloc is None:
+        parser.error('tracemalloc is not available on this Python')
+    results = run(options.sizes, options.trees, options.workloads, options.budget,
+                  options.profile, options.tracemalloc)
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,526 @@
+#!/usr/bin/env python
+
+"""
+B+ tree with the same interface as bst.Bst
+
+A search in a binary tree goes through one node per level, each a separate
+object somewhere in memory, so a tree of n values costs about log2(n)
+pointer chases per lookup. A node of a B+ tree holds up to fanout children
+or values in one contiguous list, searched with bisect, so there are only
+log(n) / log(fanout) levels to go through.
+
+Every value is in a leaf, and the leaves are linked to their neighbours,
+so iterating over a range walks along the leaves without going back up the
+tree. Inner nodes only hold separators: every value in children[i] is at
+least keys[i - 1] and below keys[i].
+
+Methods that return nodes in bst.Bst return BTreeEntry handles here, to a
+position in a leaf. A handle is only valid until the tree is next changed.
+
+Running this script executes all tests.
+
+"""
+
+__author__ = "Orko Garai (orko.garai@gmail.com)"
+
+from array import array
+from bisect import bisect_left, bisect_right
+import random
+import sys
+
+from bst import increasing_values, random_updates, unique_sorted
+
+DEFAULT_FANOUT = 64
+
+class _Leaf(object):
+    __slots__ = ('keys', 'prev', 'next')
+
+    def __init__(self, keys):
+        self.keys = keys
+        self.prev = None
+        self.next = None
+
+class _Inner(object):
+    __slots__ = ('keys', 'children')
+
+    def __init__(self, keys, children):
+        self.keys = keys
+        self.children = children
+
+class BTreeEntry(object):
+    '''
+    Handle to a value in a leaf, which looks like a Node
+    '''
+    __slots__ = ('leaf', 'index')
+
+    def __init__(self, leaf, index):
+        self.leaf = leaf
+        self.index = index
+
+    def __eq__(self, other):
+        return isinstance(other, BTreeEntry) and self.leaf is other.leaf\
+                and self.index == other.index
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((id(self.leaf), self.index))
+
+    @property
+    def val(self):
+        return self.leaf.keys[self.index]
+
+    def successor(self):
+        if self.index + 1 < len(self.leaf.keys):
+            return BTreeEntry(self.leaf, self.index + 1)
+        if self.leaf.next is None:
+            return None
+        return BTreeEntry(self.leaf.next, 0)
+
+    def predecessor(self):
+        if self.index > 0:
+            return BTreeEntry(self.leaf, self.index - 1)
+        if self.leaf.prev is None:
+            return None
+        return BTreeEntry(self.leaf.prev, len(self.leaf.prev.keys) - 1)
+
+class BPlusTree(object):
+    """
+    B+ tree of distinct values.
+
+    fanout is the largest number of values in a leaf and of children of an
+    inner node. Every node but the root holds at least half as many.
+    Passing a typecode from the array module, e.g. 'l' or 'd', stores the
+    values of every leaf in a typed array instead of a list of objects.
+    """
+    def __init__(self, fanout=DEFAULT_FANOUT, typecode=None):
+        if fanout < 3:
+            raise ValueError('Fanout must be at least 3')
+        self.fanout = fanout
+        self.typecode = typecode
+        self.min_keys = fanout // 2
+        self.min_children = (fanout + 1) // 2
+        self.root = _Leaf(self._new_keys())
+        self.first = self.last = self.root
+        self.count = 0
+
+    def _new_keys(self, values=()):
+        return list(values) if self.typecode is None else array(self.typecode, values)
+
+    def __len__(self):
+        return self.count
+
+    def is_empty(self):
+        return self.count == 0
+
+    def height(self):
+        '''
+        Returns the number of levels of the tree, counting the leaves
+        '''
+        height = 1
+        node = self.root
+        while isinstance(node, _Inner):
+            node = node.children[0]
+            height += 1
+        return height
+
+    def _leaf_for(self, val):
+        node = self.root
+        while isinstance(node, _Inner):
+            node = node.children[bisect_right(node.keys, val)]
+        return node
+
+    def _path_to(self, val):
+        '''
+        Returns the leaf where val belongs, and the inner nodes above it
+        with the index of the child taken in each
+        '''
+        path = []
+        node = self.root
+        while isinstance(node, _Inner):
+            index = bisect_right(node.keys, val)
+            path.append((node, index))
+            node = node.children[index]
+        return node, path
+
+    def find_node(self, val):
+        leaf = self._leaf_for(val)
+        keys = leaf.keys
+        index = bisect_left(keys, val)
+        if index < len(keys) and keys[index] == val:
+            return BTreeEntry(leaf, index)
+        return None
+
+    def __contains__(self, val):
+        return self.find_node(val) is not None
+
+    def insert(self, val):
+        leaf, path = self._path_to(val)
+        keys = leaf.keys
+        index = bisect_left(keys, val)
+        if index < len(keys) and keys[index] == val:
+            return False
+        keys.insert(index, val)
+        self.count += 1
+        if len(keys) > self.fanout:
+            self._split(leaf, path)
+        return True
+
+    def _split(self, node, path):
+        '''
+        Splits the overflowing node in two halves, adding the separator of
+        the new right half to the parent, and so on up the path
+        '''
+        while True:
+            if isinstance(node, _Leaf):
+                mid = len(node.keys) // 2
+                right = _Leaf(node.keys[mid:])
+                del node.keys[mid:]
+                right.prev = node
+                right.next = node.next
+                if node.next is None:
+                    self.last = right
+                else:
+                    node.next.prev = right
+                node.next = right
+                separator = right.keys[0]
+            else:
+                mid = len(node.children) // 2
+                separator = node.keys[mid - 1]
+                right = _Inner(node.keys[mid:], node.children[mid:])
+                del node.keys[mid - 1:]
+                del node.children[mid:]
+            if not path:
+                self.root = _Inner([separator], [node, right])
+                return
+            parent, index = path.pop()
+            parent.keys.insert(index, separator)
+            parent.children.insert(index + 1, right)
+            if len(parent.children) <= self.fanout:
+                return
+            node = parent
+
+    def delete(self, val):
+        leaf, path = self._path_to(val)
+        keys = leaf.keys
+        index = bisect_left(keys, val)
+        if index == len(keys) or keys[index] != val:
+            return False
+        del keys[index]
+        self.count -= 1
+        node = leaf
+        while path:
+            parent, index = path.pop()
+            if isinstance(node, _Leaf):
+                if len(node.keys) >= self.min_keys:
+                    return True
+                self._fix_leaf(parent, index)
+            else:
+                if len(node.children) >= self.min_children:
+                    return True
+                self._fix_inner(parent, index)
+            node = parent
+        if isinstance(self.root, _Inner) and len(self.root.children) == 1:
+            self.root = self.root.children[0]
+        return True
+
+    def _fix_leaf(self, parent, index):
+        '''
+        Refills the leaf parent.children[index] from a sibling, or merges
+        it with one
+        '''
+        leaf = parent.children[index]
+        if index > 0 and len(parent.children[index - 1].keys) > self.min_keys:
+            left = parent.children[index - 1]
+            leaf.keys.insert(0, left.keys.pop())
+            parent.keys[index - 1] = leaf.keys[0]
+        elif index + 1 < len(parent.children) and \
+                len(parent.children[index + 1].keys) > self.min_keys:
+            right = parent.children[index + 1]
+            leaf.keys.append(right.keys.pop(0))
+            parent.keys[index] = right.keys[0]
+        else:
+            if index == 0:
+                index += 1
+            left, right = parent.children[index - 1], parent.children[index]
+            left.keys.extend(right.keys)
+            left.next = right.next
+            if right.next is None:
+                self.last = left
+            else:
+                right.next.prev = left
+            del parent.keys[index - 1]
+            del parent.children[index]
+
+    def _fix_inner(self, parent, index):
+        '''
+        Refills the inner node parent.children[index] from a sibling, or
+        merges it with one, moving the separators through the parent
+        '''
+        node = parent.children[index]
+        if index > 0 and len(parent.children[index - 1].children) > self.min_children:
+            left = parent.children[index - 1]
+            node.children.insert(0, left.children.pop())
+            node.keys.insert(0, parent.keys[index - 1])
+            parent.keys[index - 1] = left.keys.pop()
+        elif index + 1 < len(parent.children) and \
+                len(parent.children[index + 1].children) > self.min_children:
+            right = parent.children[index + 1]
+            node.children.append(right.children.pop(0))
+            node.keys.append(parent.keys[index])
+            parent.keys[index] = right.keys.pop(0)
+        else:
+            if index == 0:
+                index += 1
+            left, right = parent.children[index - 1], parent.children[index]
+            left.keys.append(parent.keys[index - 1])
+            left.keys.extend(right.keys)
+            left.children.extend(right.children)
+            del parent.keys[index - 1]
+            del parent.children[index]
+
+    def min_node(self):
+        return BTreeEntry(self.first, 0) if self.count else None
+
+    def max_node(self):
+        return BTreeEntry(self.last, len(self.last.keys) - 1) if self.count else None
+
+    def ceiling_node(self, val=None):
+        '''
+        Returns the node with the smallest value >= val
+        '''
+        if val is None:
+            return self.min_node()
+        leaf = self._leaf_for(val)
+        index = bisect_left(leaf.keys, val)
+        if index < len(leaf.keys):
+            return BTreeEntry(leaf, index)
+        return BTreeEntry(leaf.next, 0) if leaf.next is not None else None
+
+    def floor_node(self, val=None):
+        '''
+        Returns the node with the largest value <= val
+        '''
+        if val is None:
+            return self.max_node()
+        leaf = self._leaf_for(val)
+        index = bisect_right(leaf.keys, val)
+        if index > 0:
+            return BTreeEntry(leaf, index - 1)
+        if leaf.prev is None:
+            return None
+        return BTreeEntry(leaf.prev, len(leaf.prev.keys) - 1)
+
+    def get_values(self):
+        values = []
+        leaf = self.first
+        while leaf is not None:
+            values.extend(leaf.keys)
+            leaf = leaf.next
+        return values
+
+    def __iter__(self):
+        return self.iter_values()
+
+    def __reversed__(self):
+        return self.iter_values(reverse=True)
+
+    def iter_values(self, reverse=False):
+        return self.iter_range(reverse=reverse)
+
+    def iter_range(self, lo=None, hi=None, reverse=False):
+        '''
+        Lazily yields the values v with lo <= v <= hi in order, or in reverse
+        order. A bound of None leaves that side open. Seeking to the first
+        value takes O(log n) and the rest are read a leaf at a time.
+        '''
+        if reverse:
+            leaf = self.last if hi is None else self._leaf_for(hi)
+            stop = len(leaf.keys) if hi is None else bisect_right(leaf.keys, hi)
+            while leaf is not None:
+                keys = leaf.keys
+                start = 0 if lo is None else bisect_left(keys, lo, 0, stop)
+                for i in xrange(stop - 1, start - 1, -1):
+                    yield keys[i]
+                if start > 0:
+                    return
+                leaf = leaf.prev
+                if leaf is not None:
+                    stop = len(leaf.keys)
+        else:
+            leaf = self.first if lo is None else self._leaf_for(lo)
+            start = 0 if lo is None else bisect_left(leaf.keys, lo)
+            while leaf is not None:
+                keys = leaf.keys
+                stop = len(keys) if hi is None else bisect_right(keys, hi, start)
+                for i in xrange(start, stop):
+                    yield keys[i]
+                if stop < len(keys):
+                    return
+                leaf = leaf.next
+                start = 0
+
+    @classmethod
+    def from_sorted(cls, values, **kwargs):
+        '''
+        Builds a tree from strictly increasing values in O(n), with every
+        node filled as evenly as possible. Takes the same keyword arguments
+        as the constructor.
+        '''
+        values = increasing_values(values)
+        tree = cls(**kwargs)
+        if not values:
+            return tree
+        leaves = [_Leaf(tree._new_keys(group)) for group in _groups(values, tree.fanout)]
+        for left, right in zip(leaves, leaves[1:]):
+            left.next = right
+            right.prev = left
+        tree.first, tree.last = leaves[0], leaves[-1]
+        tree.count = len(values)
+        # Every level is paired with the smallest value under each node
+        level = zip([leaf.keys[0] for leaf in leaves], leaves)
+        while len(level) > 1:
+            level = [(group[0][0], _Inner([low for low, node in group[1:]],
+                                          [node for low, node in group]))
+                     for group in _groups(level, tree.fanout)]
+        tree.root = level[0][1]
+        return tree
+
+    @classmethod
+    def from_iterable(cls, values, **kwargs):
+        '''
+        Builds a tree from values in any order, dropping duplicates
+        '''
+        return cls.from_sorted(unique_sorted(values), **kwargs)
+
+    def memory_size(self):
+        '''
+        Returns the bytes used by the nodes, their lists and the values
+        '''
+        size = sys.getsizeof(self)
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            size += sys.getsizeof(node) + sys.getsizeof(node.keys)
+            if isinstance(node, _Inner):
+                size += sys.getsizeof(node.children)
+                stack.extend(node.children)
+            elif self.typecode is None:
+                size += sum(sys.getsizeof(val) for val in node.keys)
+        return size
+
+def _groups(items, fanout):
+    '''
+    Splits items into as few consecutive groups of at most fanout items as
+    possible, with sizes as even as possible
+    '''
+    count = (len(items) + fanout - 1) // fanout
+    return [items[i * len(items) // count:(i + 1) * len(items) // count]
+            for i in xrange(count)]
+
+def check_tree(b):
+    '''
+    Checks the ordering, separators, fill and leaf links of the tree.
+    Returns its height.
+    '''
+    leaves = []
+    def check(node, lo, hi, is_root):
+        if isinstance(node, _Leaf):
+            keys = list(node.keys)
+            assert keys == sorted(set(keys))
+            assert all((lo is None or k >= lo) and (hi is None or k < hi) for k in keys)
+            assert len(keys) <= b.fanout
+            assert is_root or len(keys) >= b.min_keys
+            leaves.append(node)
+            return 1
+        assert len(node.keys) == len(node.children) - 1
+        assert list(node.keys) == sorted(set(node.keys))
+        assert len(node.children) <= b.fanout
+        assert len(node.children) >= (2 if is_root else b.min_children)
+        bounds = [lo] + list(node.keys) + [hi]
+        heights = set(check(child, bounds[i], bounds[i + 1], False)
+                      for i, child in enumerate(node.children))
+        assert len(heights) == 1, 'Leaves must all be at the same depth'
+        return 1 + heights.pop()
+    height = check(b.root, None, None, True)
+    assert b.first is leaves[0] and b.last is leaves[-1]
+    assert leaves[0].prev is None and leaves[-1].next is None
+    for left, right in zip(leaves, leaves[1:]):
+        assert left.next is right and right.prev is left
+    assert sum(len(leaf.keys) for leaf in leaves) == len(b)
+    assert height == b.height()
+    return height
+
+def test_btree():
+    '''
+    Method that tests BPlusTree against a sorted list
+    '''
+    rand = random.Random(25)
+    for fanout in [3, 4, 5, 16]:
+        for typecode in [None, 'l']:
+            b = BPlusTree(fanout=fanout, typecode=typecode)
+            assert b.is_empty() and len(b) == 0
+            assert b.min_node() is None and b.max_node() is None
+            assert b.find_node(1) is None and b.get_values() == []
+            assert b.delete(1) is False
+            assert list(b.iter_range(1, 5)) == [] and list(reversed(b)) == []
+            values = random_updates(b, rand, 3000, 500, lambda b, values: check_tree(b))
+            assert b.get_values() == values and list(b) == values
+            assert list(reversed(b)) == values[::-1]
+            for _ in xrange(50):
+                lo, hi = sorted(rand.randint(-10, 510) for i in xrange(2))
+                in_range = [v for v in values if lo <= v <= hi]
+                assert list(b.iter_range(lo, hi)) == in_range
+                assert list(b.iter_range(lo, hi, reverse=True)) == in_range[::-1]
+                assert list(b.iter_range(lo=lo)) == [v for v in values if v >= lo]
+                assert list(b.iter_range(hi=hi, reverse=True)) == \
+                        [v for v in values if v <= hi][::-1]
+                ceiling = b.ceiling_node(lo)
+                assert (ceiling and ceiling.val) == min([v for v in values if v >= lo] or [None])
+                floor = b.floor_node(hi)
+                assert (floor and floor.val) == max([v for v in values if v <= hi] or [None])
+            assert b.min_node().val == values[0] and b.max_node().val == values[-1]
+            node = b.find_node(values[len(values) // 2])
+            assert node.val == values[len(values) // 2]
+            assert node.successor().val == values[len(values) // 2 + 1]
+            assert node.predecessor().val == values[len(values) // 2 - 1]
+            walked = []
+            node = b.min_node()
+            while node is not None:
+                walked.append(node.val)
+                node = node.successor()
+            assert walked == values
+
+            # Emptying the tree brings it back to a single leaf
+            for val in rand.sample(values, len(values)):
+                assert b.delete(val)
+            check_tree(b)
+            assert b.is_empty() and b.height() == 1
+
+            for n in [0, 1, fanout, fanout + 1, 1000]:
+                b = BPlusTree.from_sorted(xrange(n), fanout=fanout, typecode=typecode)
+                check_tree(b)
+                assert b.get_values() == range(n)
+                b.insert(n)
+                b.delete(0)
+                check_tree(b)
+                assert b.get_values() == range(1, n + 1)
+
+    b = BPlusTree.from_iterable([5, 3, 5, 1], fanout=4)
+    assert b.get_values() == [1, 3, 5]
+    b = BPlusTree.from_sorted(xrange(100000))
+    assert check_tree(b) <= 3
+    try:
+        BPlusTree.from_sorted([2, 1])
+        assert False, 'Unsorted values should be rejected'
+    except ValueError:
+        pass
+    try:
+        BPlusTree(fanout=2)
+        assert False, 'Fanouts below 3 should be rejected'
+    except ValueError:
+        pass
+
+if __name__ == '__main__':
+    test_btree()
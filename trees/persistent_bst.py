@@ -0,0 +1,444 @@
+#!/usr/bin/env python
+
+"""
+Persistent BST, where every change makes a new version of the tree
+
+A bst.Bst changes its nodes in place, so a thread reading it while another
+one writes can see it half way through a rotation. The nodes of a
+PersistentBst are never changed once made. Inserting or deleting a value
+copies the nodes on the path from the root down to it, up to O(log n) of
+them on a balanced tree, and shares every other subtree with the previous
+version, which stays as it was.
+
+The nodes have no parent pointers, since a node shared by several versions
+has a different parent in each. Iteration keeps a stack of the nodes on the
+path instead.
+
+snapshot() returns a BstSnapshot of the current version in O(1). Readers can
+use it without any lock while a writer keeps changing the tree, since the
+root of the tree is replaced by a single assignment once a new version is
+complete. Several writers still need a lock between them.
+
+Running this script executes all tests.
+
+"""
+
+__author__ = "Orko Garai (orko.garai@gmail.com)"
+
+from threading import Thread
+import random
+
+from bst import increasing_values, random_updates
+
+class PersistentNode(object):
+    '''
+    Node of a PersistentBst, which is not changed once made
+    '''
+    __slots__ = ('val', 'left', 'right', 'height', 'size')
+
+    def __init__(self, val, left, right):
+        self.val = val
+        self.left = left
+        self.right = right
+        self.height = 1 + max(_height(left), _height(right))
+        self.size = 1 + _size(left) + _size(right)
+
+    def is_leaf(self):
+        return self.left is None and self.right is None
+
+def _height(node):
+    return 0 if node is None else node.height
+
+def _size(node):
+    return 0 if node is None else node.size
+
+def _balance(val, left, right):
+    '''
+    Makes a node holding val over the subtrees left and right, whose heights
+    differ by at most 2, rotating so that the result is AVL balanced
+    '''
+    left_height, right_height = _height(left), _height(right)
+    if left_height > right_height + 1:
+        if _height(left.left) >= _height(left.right):
+            return PersistentNode(left.val, left.left,
+                                  PersistentNode(val, left.right, right))
+        pivot = left.right
+        return PersistentNode(pivot.val, PersistentNode(left.val, left.left, pivot.left),
+                              PersistentNode(val, pivot.right, right))
+    if right_height > left_height + 1:
+        if _height(right.right) >= _height(right.left):
+            return PersistentNode(right.val, PersistentNode(val, left, right.left),
+                                  right.right)
+        pivot = right.left
+        return PersistentNode(pivot.val, PersistentNode(val, left, pivot.left),
+                              PersistentNode(right.val, pivot.right, right.right))
+    return PersistentNode(val, left, right)
+
+class BstSnapshot(object):
+    """
+    Read-only view of one version of a PersistentBst
+    """
+    __slots__ = ('root', 'balanced')
+
+    def __init__(self, root, balanced):
+        self.root = root
+        self.balanced = balanced
+
+    def is_empty(self):
+        return self.root is None
+
+    def __len__(self):
+        return _size(self.root)
+
+    def find_node(self, val):
+        node = self.root
+        while node is not None:
+            if val == node.val:
+                return node
+            node = node.left if val < node.val else node.right
+        return None
+
+    def __contains__(self, val):
+        return self.find_node(val) is not None
+
+    def min_node(self):
+        node = self.root
+        if node is None:
+            return None
+        while node.left is not None:
+            node = node.left
+        return node
+
+    def max_node(self):
+        node = self.root
+        if node is None:
+            return None
+        while node.right is not None:
+            node = node.right
+        return node
+
+    def ceiling_node(self, val=None):
+        '''
+        Returns the node with the smallest value >= val
+        '''
+        if val is None:
+            return self.min_node()
+        node = self.root
+        found = None
+        while node is not None:
+            if val == node.val:
+                return node
+            if val < node.val:
+                found = node
+                node = node.left
+            else:
+                node = node.right
+        return found
+
+    def floor_node(self, val=None):
+        '''
+        Returns the node with the largest value <= val
+        '''
+        if val is None:
+            return self.max_node()
+        node = self.root
+        found = None
+        while node is not None:
+            if val == node.val:
+                return node
+            if val > node.val:
+                found = node
+                node = node.right
+            else:
+                node = node.left
+        return found
+
+    def get_values(self):
+        return list(self.iter_values())
+
+    def __iter__(self):
+        return self.iter_values()
+
+    def __reversed__(self):
+        return self.iter_values(reverse=True)
+
+    def iter_values(self, reverse=False):
+        return self.iter_range(reverse=reverse)
+
+    def iter_range(self, lo=None, hi=None, reverse=False):
+        '''
+        Lazily yields the values v with lo <= v <= hi in order, or in reverse
+        order. A bound of None leaves that side open. The stack of the nodes
+        still to visit holds O(height) of them.
+        '''
+        # Walking in reverse is the same as walking in order with the
+        # children and bounds swapped
+        first, last = (hi, lo) if reverse else (lo, hi)
+        before = (lambda a, b: a > b) if reverse else (lambda a, b: a < b)
+        stack = []
+        node = self.root
+        while node is not None:
+            if first is not None and before(node.val, first):
+                node = node.left if reverse else node.right
+            else:
+                stack.append(node)
+                node = node.right if reverse else node.left
+        while stack:
+            node = stack.pop()
+            if last is not None and before(last, node.val):
+                return
+            yield node.val
+            node = node.left if reverse else node.right
+            while node is not None:
+                stack.append(node)
+                node = node.right if reverse else node.left
+
+    def rank(self, val):
+        '''
+        Returns the number of values < val
+        '''
+        node = self.root
+        rank = 0
+        while node is not None:
+            if node.val < val:
+                rank += _size(node.left) + 1
+                node = node.right
+            else:
+                node = node.left
+        return rank
+
+    def select(self, k):
+        '''
+        Returns the node holding the k-th smallest value, counting from 0
+        '''
+        if not 0 <= k < len(self):
+            raise IndexError('Tree has no value at position %s' % k)
+        node = self.root
+        while True:
+            left_size = _size(node.left)
+            if k < left_size:
+                node = node.left
+            elif k == left_size:
+                return node
+            else:
+                k -= left_size + 1
+                node = node.right
+
+class PersistentBst(BstSnapshot):
+    """
+    Binary search tree that keeps its old versions, see the module docstring.
+
+    Passing balanced=True keeps every version AVL balanced, like bst.Bst.
+    The tree reads like a snapshot of its latest version.
+    """
+    __slots__ = ()
+
+    def __init__(self, balanced=False):
+        super(PersistentBst, self).__init__(None, balanced)
+
+    def snapshot(self):
+        '''
+        Returns a BstSnapshot of the current version of the tree in O(1)
+        '''
+        return BstSnapshot(self.root, self.balanced)
+
+    @classmethod
+    def from_sorted(cls, values, **kwargs):
+        '''
+        Builds a perfectly balanced tree from strictly increasing values in
+        O(n), sharing nothing with other trees. Takes the same keyword
+        arguments as the constructor.
+        '''
+        values = increasing_values(values)
+        tree = cls(**kwargs)
+        tree.root = _build(values, 0, len(values))
+        return tree
+
+    def _path_to(self, val):
+        '''
+        Returns the nodes from the root down to the node holding val, or
+        down to the last node visited if there is none
+        '''
+        path = []
+        node = self.root
+        while node is not None:
+            path.append(node)
+            if val == node.val:
+                break
+            node = node.left if val < node.val else node.right
+        return path
+
+    def _rebuild(self, path, val, subtree):
+        '''
+        Copies the nodes of path, where subtree replaces the child of the
+        last one on the side of val, and returns the new root
+        '''
+        make = _balance if self.balanced else PersistentNode
+        for node in reversed(path):
+            if val < node.val:
+                subtree = make(node.val, subtree, node.right)
+            else:
+                subtree = make(node.val, node.left, subtree)
+        return subtree
+
+    def insert(self, val):
+        path = self._path_to(val)
+        if path and path[-1].val == val:
+            return False
+        self.root = self._rebuild(path, val, PersistentNode(val, None, None))
+        return True
+
+    def delete(self, val):
+        path = self._path_to(val)
+        if not path or path[-1].val != val:
+            return False
+        node = path.pop()
+        if node.left is None:
+            subtree = node.right
+        elif node.right is None:
+            subtree = node.left
+        else:
+            # Takes the in-order successor out of the right subtree, to put
+            # it in place of node
+            right_path = []
+            successor = node.right
+            while successor.left is not None:
+                right_path.append(successor)
+                successor = successor.left
+            right = self._rebuild(right_path, successor.val, successor.right)
+            make = _balance if self.balanced else PersistentNode
+            subtree = make(successor.val, node.left, right)
+        self.root = self._rebuild(path, val, subtree)
+        return True
+
+def _build(values, lo, hi):
+    if lo >= hi:
+        return None
+    mid = (lo + hi) // 2
+    return PersistentNode(values[mid], _build(values, lo, mid), _build(values, mid + 1, hi))
+
+def check_tree(b):
+    '''
+    Checks the ordering and sizes of the tree, along with the AVL invariant
+    for balanced trees. Returns the height of the tree.
+    '''
+    def check(node, lo, hi):
+        if node is None:
+            return 0
+        assert lo is None or node.val > lo
+        assert hi is None or node.val < hi
+        left = check(node.left, lo, node.val)
+        right = check(node.right, node.val, hi)
+        if b.balanced:
+            assert abs(left - right) <= 1
+        assert node.height == 1 + max(left, right)
+        assert node.size == 1 + _size(node.left) + _size(node.right)
+        return 1 + max(left, right)
+    return check(b.root, None, None)
+
+def test_persistent_bst():
+    '''
+    Method that tests PersistentBst against a sorted list, and that its
+    snapshots never change
+    '''
+    rand = random.Random(24)
+    for balanced in [False, True]:
+        b = PersistentBst(balanced=balanced)
+        assert b.is_empty() and len(b) == 0
+        assert b.min_node() is None and b.max_node() is None
+        assert b.get_values() == [] and b.delete(1) is False
+        snapshots = []
+        def check(b, values):
+            check_tree(b)
+            snapshots.append((b.snapshot(), sorted(values)))
+        values = random_updates(b, rand, 2000, 300, check)
+        height = check_tree(b)
+        if balanced:
+            assert height <= 1.45 * len(b).bit_length()
+        assert b.get_values() == values and len(b) == len(values)
+        assert list(reversed(b)) == values[::-1]
+        for lo, hi in [(100, 200), (None, 50), (250, None), (-5, -1), (None, None)]:
+            in_range = [v for v in values if (lo is None or v >= lo) and (hi is None or v <= hi)]
+            assert list(b.iter_range(lo, hi)) == in_range
+            assert list(b.iter_range(lo, hi, reverse=True)) == in_range[::-1]
+        assert b.min_node().val == values[0] and b.max_node().val == values[-1]
+        assert b.ceiling_node(-1).val == values[0] and b.floor_node(-1) is None
+        assert [b.select(k).val for k in xrange(len(values))] == values
+        assert [b.rank(v) for v in values] == range(len(values))
+        assert (150 in b) == (150 in values)
+
+        # Old versions are left as they were
+        for snapshot, snapshot_values in snapshots:
+            assert snapshot.get_values() == snapshot_values
+            assert len(snapshot) == len(snapshot_values)
+        snapshot = b.snapshot()
+        for val in values:
+            b.delete(val)
+        assert b.is_empty() and snapshot.get_values() == values
+
+        # Every change copies only the path to the value
+        b = PersistentBst.from_sorted(xrange(1000), balanced=balanced)
+        before = b.snapshot()
+        b.insert(1000)
+        shared = set(map(id, _nodes(before.root))) & set(map(id, _nodes(b.root)))
+        assert len(shared) >= 1000 - 2 * check_tree(b)
+
+    try:
+        PersistentBst.from_sorted([2, 1])
+        assert False, 'Unsorted values should be rejected'
+    except ValueError:
+        pass
+
+def _nodes(node):
+    stack = [node] if node is not None else []
+    while stack:
+        node = stack.pop()
+        yield node
+        stack.extend(child for child in (node.left, node.right) if child is not None)
+
+def test_concurrent_readers():
+    '''
+    Method that tests readers going through snapshots while a writer changes
+    the tree, with no lock
+    '''
+    b = PersistentBst(balanced=True)
+    done = []
+    errors = []
+
+    def write():
+        rand = random.Random(1)
+        for i in xrange(20000):
+            # The tree always holds all the even values below 100, along with
+            # odd values coming and going
+            if i < 50:
+                b.insert(2 * i)
+            elif rand.random() < 0.5:
+                b.insert(2 * rand.randrange(1000) + 1)
+            else:
+                b.delete(2 * rand.randrange(1000) + 1)
+        done.append(True)
+
+    def read():
+        try:
+            while not done:
+                snapshot = b.snapshot()
+                values = snapshot.get_values()
+                assert values == sorted(set(values))
+                assert len(values) == len(snapshot)
+                if 98 in snapshot:
+                    # The last of the even values is only inserted after the others
+                    assert [v for v in values if v % 2 == 0 and v < 100] == range(0, 100, 2)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [Thread(target=write)] + [Thread(target=read) for i in xrange(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors, errors
+    check_tree(b)
+
+if __name__ == '__main__':
+    test_persistent_bst()
+    test_concurrent_readers()